@@ -0,0 +1,235 @@
+import asyncio
+import concurrent.futures
+import time
+
+import cv2
+import keyboard
+
+from FlightController import FlightController
+from FrameSource import FrameSource
+from PIDController import PIDController
+from PreviewDisplay import PreviewDisplay
+from VelocityEstimator import VelocityEstimator
+from VelocityFilter import VelocityFilter
+from main import PLANT_GAIN, handle_keyboard_input
+
+
+class PacketProtocol(asyncio.DatagramProtocol):
+    """
+    The drone does not reply on the control port, so nothing needs to be handled here.
+    """
+    def error_received(self, exc):
+        print("Control link error:", exc)
+
+
+class ControlRuntime:
+    """
+    An asyncio alternative to the while loop in main.py. Each part of the loop runs as its own task with its own rate:
+    - packets: sends the latest control packet over a UDP datagram endpoint.
+    - input: polls the keyboard, toggles autopilot and handles exit.
+    - vision: waits for a new frame and estimates the velocity in an executor thread, then updates the PID controller.
+    - preview: shows the newest frame, downscaled with the velocity and trim drawn on it (see PreviewDisplay).
+    A slow vision frame only delays the vision task, so the packet and input rates no longer depend on the slowest stage.
+
+    Every task is scheduled against deadlines on the event loop's monotonic clock. If a step overruns its period the
+    missed deadlines are skipped and counted in self.stats.
+
+    The autopilot is the only owner of the roll while it is on. If any task raises, the other tasks are stopped, one last
+    packet with the roll back at its trim center is sent and run() raises the task's exception, instead of the remaining
+    tasks carrying on with a stale roll.
+    """
+    def __init__(self, flight_controller, velocity_estimator, pid_controller, frame_source,
+                 packet_rate=20, input_rate=50, vision_rate=20, preview_rate=10, frames_to_skip=2, velocity_filter=None,
+                 headless=False, flight_recorder=None):
+        """
+        :param headless: Run without the preview window.
+        :param flight_recorder: Optional FlightRecorder every vision step is logged to, as in main.py.
+        :param velocity_filter: Optional VelocityFilter. If given, the vision task only updates the filter, and a control
+                                task runs the PID controller on the filtered velocity at the packet rate, so the roll
+                                keeps being corrected between vision updates and when an estimate fails.
+        """
+        self.flight_controller = flight_controller
+        self.velocity_estimator = velocity_estimator
+        self.pid_controller = pid_controller
+        self.frame_source = frame_source
+        self.velocity_filter = velocity_filter
+        self.flight_recorder = flight_recorder
+        # The preview task already runs at preview_rate, so the display does not limit its rate again
+        self.preview = PreviewDisplay(frame_source, rate=float("inf"), headless=headless)
+        self.rates = {"packets": packet_rate, "input": input_rate, "vision": vision_rate, "preview": preview_rate}
+        if velocity_filter is not None:
+            self.rates["control"] = packet_rate
+        self.frames_to_skip = frames_to_skip
+
+        self.auto_pilot_enabled = False
+        self.p_is_pressed = False
+        self.last_frame_num = 0
+        # Per task: number of steps run, deadlines missed, and the largest delay past a deadline in seconds.
+        self.stats = {name: {"steps": 0, "missed_deadlines": 0, "max_lateness": 0.0} for name in self.rates}
+
+        # One thread, so the estimator is never run concurrently with itself.
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._transport = None
+        self._stopped = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        self._transport, _ = await loop.create_datagram_endpoint(
+            PacketProtocol, remote_addr=(self.flight_controller.control_packet_ip, self.flight_controller.control_packet_port))
+
+        steps = {"packets": self.packet_step, "input": self.input_step, "vision": self.vision_step, "preview": self.preview_step,
+                 "control": self.control_step}
+        tasks = [asyncio.create_task(self._run_periodic(name, steps[name]), name=name) for name in self.rates]
+        stopped = asyncio.create_task(self._stopped.wait())
+        await asyncio.wait([stopped, *tasks], return_when=asyncio.FIRST_COMPLETED)
+
+        failed = [task for task in tasks if task.done() and not task.cancelled() and task.exception() is not None]
+        stopped.cancel()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(stopped, *tasks, return_exceptions=True)
+        if failed:
+            print(f"The {failed[0].get_name()} task failed, stopping")
+            self.auto_pilot_enabled = False
+            self.flight_controller.set_command_state(control_roll=self.flight_controller.control_roll_center)
+            # The packet task is stopped, so send the centered roll here or the drone keeps the last one
+            try:
+                self._transport.sendto(self.flight_controller.latest_packet())
+            except OSError as e:
+                print("Could not send the final packet:", e)
+        self._transport.close()
+        self._executor.shutdown(wait=False)
+        if failed:
+            raise failed[0].exception()
+
+    def stop(self):
+        self._stopped.set()
+
+    async def _run_periodic(self, name, step):
+        loop = asyncio.get_running_loop()
+        period = 1.0 / self.rates[name]
+        stats = self.stats[name]
+        deadline = loop.time()
+        while True:
+            delay = deadline - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            stats["max_lateness"] = max(stats["max_lateness"], loop.time() - deadline)
+
+            await step()
+            stats["steps"] += 1
+
+            deadline += period
+            missed = int((loop.time() - deadline) // period)
+            if missed > 0:
+                stats["missed_deadlines"] += missed
+                deadline += missed * period
+
+    async def packet_step(self):
+        self._transport.sendto(self.flight_controller.latest_packet())
+
+    async def input_step(self):
+        key_pressed = handle_keyboard_input(self.flight_controller, self.auto_pilot_enabled)
+        if key_pressed:
+            self.auto_pilot_enabled = False
+            self._reset_autopilot()
+
+        if keyboard.is_pressed('p'): # Toggle autopilot mode
+            if not self.p_is_pressed:
+                print("Toggling Autopilot")
+                self.auto_pilot_enabled = not self.auto_pilot_enabled
+                self._reset_autopilot()
+            self.p_is_pressed = True
+        else:
+            self.p_is_pressed = False
+
+        # Press escape to exit the program. Note that the drone will stop receiving control packets, which should cause it to hover or crash.
+        if keyboard.is_pressed("esc"):
+            print("Exiting program")
+            self.stop()
+
+    def _reset_autopilot(self):
+        self.pid_controller.reset()
+        if self.velocity_filter is not None:
+            self.velocity_filter.reset()
+        self.velocity_estimator.previous_frame = None
+
+    async def vision_step(self):
+        if not self.auto_pilot_enabled:
+            return
+        loop = asyncio.get_running_loop()
+        # Skip frames to amplify difference between images if the drone is moving slowly.
+        frame = await loop.run_in_executor(self._executor, self.frame_source.latest_newer_than,
+                                           self.last_frame_num + self.frames_to_skip - 1, 1.0)
+        if frame is None:
+            print("Failed to read frame")
+            return
+        self.last_frame_num, capture_time, img = frame
+
+        velocity = await loop.run_in_executor(self._executor, self.velocity_estimator.estimate_velocity, img)
+        # Autopilot may have been turned off while the frame was being processed
+        if not self.auto_pilot_enabled:
+            return
+        if velocity is None:
+            print("Velocity estimation failed, skipping PID update.")
+            if self.velocity_filter is not None:
+                self.velocity_filter.miss()
+        elif self.velocity_filter is not None:
+            self.velocity_filter.update(velocity, self.velocity_estimator.variance, capture_time)
+        else:
+            control_output = self.pid_controller.update(velocity, timestamp=capture_time)
+            trim = 128 - int(control_output)
+            print("Trim: ", trim, f"Velocity: {velocity:.4f}")
+            self.flight_controller.set_command_state(control_roll=trim)
+            self.preview.set_status(velocity=velocity, trim=trim)
+
+        if self.flight_recorder is not None:
+            # The variance and inliers are left over from the last success when the estimate failed
+            variance, inliers = (self.velocity_estimator.variance, self.velocity_estimator.inliers) if velocity is not None else (None, -1)
+            self.flight_recorder.log(self.flight_controller, self.pid_controller, self.last_frame_num, capture_time, velocity,
+                                     variance, inliers)
+
+    async def control_step(self):
+        """
+        Runs the PID controller on the filtered velocity. Only used with a velocity_filter.
+        """
+        if not self.auto_pilot_enabled:
+            return
+        now = time.monotonic() # The clock of the frames' capture times
+        velocity = self.velocity_filter.predict(now)
+        control_output = self.pid_controller.update(velocity, timestamp=now)
+        self.velocity_filter.predict(now, control_output)
+        self.flight_controller.set_command_state(control_roll=128 - int(control_output))
+        self.preview.set_status(velocity=velocity, trim=128 - int(control_output))
+
+    async def preview_step(self):
+        self.preview.step()
+        if self.preview.quit_requested:
+            self.stop()
+
+
+if __name__ == "__main__":
+    """
+    Runs the same setup as main.py on the asyncio runtime.
+    """
+    flight_controller = FlightController()
+    velocity_estimator = VelocityEstimator(method="feature_matching")
+    pid_controller = PIDController(kp=300, ki=300, kd=10, output_limits=(-127, 127)) # kp=300, ki=300, kd=10
+    # Set to True to run the PID controller at the packet rate on a Kalman filtered velocity, as in main.py.
+    use_velocity_filter = False
+    velocity_filter = VelocityFilter(plant_gain=PLANT_GAIN) if use_velocity_filter else None
+
+    drone_url = "rtsp://192.168.1.1:7070/webcam"
+    frame_source = FrameSource(drone_url).start()
+
+    runtime = ControlRuntime(flight_controller, velocity_estimator, pid_controller, frame_source, velocity_filter=velocity_filter)
+    start_time = time.monotonic()
+    try:
+        asyncio.run(runtime.run())
+    finally:
+        frame_source.stop()
+        cv2.destroyAllWindows()
+        print(f"Ran for {time.monotonic() - start_time:.1f} s")
+        for name, stats in runtime.stats.items():
+            print(name, stats)
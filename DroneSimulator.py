@@ -0,0 +1,315 @@
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+
+from FrameSource import random_texture
+
+# A local stand-in for the drone, for running the control loop end to end without it.
+# DroneSimulator listens for control packets on a UDP port like the drone does, checks them, and feeds the roll and
+# pitch commands into the drone model of test_PID.py. Its camera renders a texture shifted by the simulated position and
+# can be used as the FrameSource source in place of the RTSP url.
+#
+# The camera is modelled as looking down, so roll moves the scene horizontally and pitch vertically. The model
+# constants are chosen so that with the roll at 128 and the true center at 140 the drone drifts at about 180 pixels per
+# second, which feature matching with frames_to_skip = 2 reports as the 0.04 velocity seen in hover on the real drone.
+#
+# Running this file flies the real autopilot loop against the simulator, headless: the while loop of main.py, or the
+# asyncio runtime of ControlRuntime.py with --runtime asyncio, including their keyboard handling, with the keyboard
+# replaced by a script that presses p to start the autopilot and escape to end the flight. It reports the packet rate,
+# the latency from frame capture to the control packet arriving, and how well the drone was held still:
+#   python DroneSimulator.py --duration 20 --method feature_matching
+
+
+def decode_packet(data):
+    """
+    Decodes a control packet built by FlightController.construct_packet.
+
+    Returns: dict with roll, pitch, accelerator, turn and flags, or None if the packet is malformed or its checksum is wrong.
+    """
+    if len(data) != 9 or data[0] != 0x03 or data[1] != 0x66 or data[8] != 0x99:
+        return None
+    roll, pitch, accelerator, turn, flags, checksum = data[2:8]
+    if roll ^ pitch ^ accelerator ^ turn ^ flags != checksum:
+        return None
+    return {"roll": roll, "pitch": pitch, "accelerator": accelerator, "turn": turn, "flags": flags}
+
+
+class DroneSimulator:
+    def __init__(self, host="127.0.0.1", port=7099, true_center=(140, 128), acceleration_per_trim=15.0, drag=1 / 180):
+        """
+        :param host, port: Address to receive control packets on. Set FlightController.control_packet_ip and
+                           control_packet_port to the same.
+        :param true_center: (roll, pitch) commands that hold the drone still.
+        :param acceleration_per_trim: Acceleration of the scene in pixels per second squared per unit of command away from the true center.
+        :param drag: Quadratic drag, in 1 / pixels.
+        """
+        self.address = (host, port)
+        self.true_center = np.array(true_center, dtype=np.float64)
+        self.acceleration_per_trim = acceleration_per_trim
+        self.drag = drag
+
+        # Position and velocity of the drone in pixels of the 640x480 camera image, x from roll and y from pitch
+        self.position = np.zeros(2)
+        self.velocity = np.zeros(2)
+        self.command = np.array([128.0, 128.0])
+        self._time = None
+        self._lock = threading.Lock()
+
+        self.packets_received = 0
+        self.invalid_packets = 0
+        self.arrival_times = deque(maxlen=1000)
+        # (arrival time, roll) of every packet whose roll differs from the packet before it
+        self.roll_changes = deque(maxlen=10000)
+        # (arrival time, x velocity) at every valid packet
+        self.velocity_log = deque(maxlen=100000)
+        self._last_roll = None
+
+        self._sock = None
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind(self.address)
+        self._sock.settimeout(0.1)
+        self._running = True
+        self._thread = threading.Thread(target=self._receive_loop, name="simulator", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._sock.close()
+
+    def camera(self, width=640, height=480, fps=20, seed=0):
+        return SimulatedCamera(self, width, height, fps, seed)
+
+    def _receive_loop(self):
+        while self._running:
+            try:
+                data, _ = self._sock.recvfrom(64)
+            except socket.timeout:
+                continue
+            arrival_time = time.monotonic()
+            packet = decode_packet(data)
+            if packet is None:
+                self.invalid_packets += 1
+                continue
+            self.packets_received += 1
+            self.arrival_times.append(arrival_time)
+            if packet["roll"] != self._last_roll:
+                self._last_roll = packet["roll"]
+                self.roll_changes.append((arrival_time, packet["roll"]))
+            with self._lock:
+                self._advance(arrival_time)
+                self.command[:] = (packet["roll"], packet["pitch"])
+                self.velocity_log.append((arrival_time, self.velocity[0]))
+
+    def _advance(self, now):
+        """
+        Integrates the drone model up to now with the current command. Called with the lock held.
+        """
+        if self._time is None:
+            self._time = now
+            return
+        remaining = now - self._time
+        self._time = now
+        while remaining > 0:
+            dt = min(remaining, 0.005)
+            acceleration = (self.command - self.true_center) * self.acceleration_per_trim
+            acceleration -= self.drag * self.velocity * np.abs(self.velocity)
+            self.velocity += acceleration * dt
+            self.position += self.velocity * dt
+            remaining -= dt
+
+    def state(self):
+        """
+        Returns: (position, velocity) of the drone in pixels and pixels per second, at the current time.
+        """
+        with self._lock:
+            self._advance(time.monotonic())
+            return self.position.copy(), self.velocity.copy()
+
+    def get_stats(self):
+        """
+        Returns: dict with packets_received, invalid_packets, and the packet rate and interval jitter (p95 of the
+                 deviation from the mean interval, in seconds) over the last packets.
+        """
+        stats = {"packets_received": self.packets_received, "invalid_packets": self.invalid_packets,
+                 "packet_rate": 0.0, "interval_jitter_p95": 0.0}
+        arrivals = np.array(self.arrival_times)
+        if len(arrivals) > 2:
+            intervals = np.diff(arrivals)
+            stats["packet_rate"] = float(1.0 / intervals.mean())
+            stats["interval_jitter_p95"] = float(np.percentile(np.abs(intervals - intervals.mean()), 95))
+        return stats
+
+
+class SimulatedCamera:
+    """
+    VideoCapture-like camera of a DroneSimulator. read() waits for the next frame time like a live camera and renders
+    the scene at the drone's position, so FrameSource treats it as a stream.
+    """
+    is_stream = True
+
+    def __init__(self, simulator, width=640, height=480, fps=20, seed=0):
+        self.simulator = simulator
+        self.width, self.height = width, height
+        self.fps = fps
+        self.texture = random_texture(width * 2, height * 2, seed)
+        self.transform = np.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]])
+        self.next_frame_time = time.monotonic()
+        self.opened = True
+
+    def isOpened(self):
+        return self.opened
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.width
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.height
+        return 0
+
+    def read(self):
+        if not self.opened:
+            return False, None
+        self.next_frame_time = max(self.next_frame_time + 1.0 / self.fps, time.monotonic())
+        time.sleep(max(0.0, self.next_frame_time - time.monotonic()))
+        position, _ = self.simulator.state()
+        # The scene moves the opposite way to the drone. Wrapping keeps the whole frame textured.
+        self.transform[:, 2] = -position * (self.width / 640)
+        frame = cv2.warpAffine(self.texture, self.transform, (self.width, self.height),
+                               flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_WRAP)
+        return True, frame
+
+    def release(self):
+        self.opened = False
+
+
+class ScriptedKeyboard:
+    """
+    Stands in for the keyboard module, so the real keyboard handling of main.py and ControlRuntime runs unattended.
+    Keys are held over time ranges on the monotonic clock.
+    """
+    def __init__(self):
+        self.held = [] # (key, start time, end time)
+
+    def hold(self, key, start, end=float("inf")):
+        self.held.append((key, start, end))
+
+    def is_pressed(self, key):
+        now = time.monotonic()
+        return any(held_key == key and start <= now < end for held_key, start, end in self.held)
+
+
+def roll_latencies(records, roll_changes):
+    """
+    Returns: the latency from the capture of a frame to the first packet carrying the roll computed from it, for every
+             logged step (FlightRecorder records) that changed the roll.
+    """
+    latencies = []
+    for previous, record in zip(records[:-1], records[1:]):
+        if record["control_roll"] == previous["control_roll"] or not np.isfinite(record["capture_time"]):
+            continue
+        for arrival_time, roll in roll_changes:
+            if arrival_time >= record["time"] and roll == record["control_roll"]:
+                latencies.append(arrival_time - record["capture_time"])
+                break
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the autopilot loop headless against a local drone simulator.")
+    parser.add_argument("--port", type=int, default=7099)
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds to fly")
+    parser.add_argument("--runtime", default="loop", choices=["loop", "asyncio"],
+                        help="The while loop of main.py or the asyncio runtime of ControlRuntime.py")
+    parser.add_argument("--method", default="feature_matching", choices=["feature_matching", "optical_flow", "sparse_flow"])
+    parser.add_argument("--flow-backend", default="farneback", help="Dense flow algorithm for --method optical_flow, see VelocityEstimator.FLOW_BACKENDS")
+    parser.add_argument("--packet-rate", type=float, default=20)
+    parser.add_argument("--frames-to-skip", type=int, default=2)
+    parser.add_argument("--velocity-filter", action="store_true", help="Run the PID controller on a VelocityFilter")
+    args = parser.parse_args()
+
+    # Both runtimes read the keyboard module, which is replaced before they are imported. The autopilot is switched on
+    # with p once the video is running, and escape ends the flight.
+    keyboard = ScriptedKeyboard()
+    sys.modules["keyboard"] = keyboard
+    import main as autopilot
+    from ControlRuntime import ControlRuntime
+    from FlightController import FlightController
+    from FlightRecorder import FlightRecorder, trim_records
+    from FrameSource import FrameSource
+    from PIDController import PIDController
+    from PreviewDisplay import PreviewDisplay
+    from VelocityEstimator import VelocityEstimator
+    from VelocityFilter import VelocityFilter
+
+    simulator = DroneSimulator(port=args.port).start()
+    flight_controller = FlightController()
+    flight_controller.control_packet_ip, flight_controller.control_packet_port = simulator.address
+    velocity_estimator = VelocityEstimator(method=args.method, flow_backend=args.flow_backend)
+    pid_controller = PIDController(kp=300, ki=300, kd=10, output_limits=(-127, 127))
+    velocity_filter = VelocityFilter(plant_gain=autopilot.PLANT_GAIN) if args.velocity_filter else None
+    frame_source = FrameSource(simulator.camera()).start()
+
+    autopilot_start = time.monotonic() + 1.0
+    end_time = autopilot_start + args.duration
+    keyboard.hold("p", autopilot_start, autopilot_start + 0.15)
+    keyboard.hold("esc", end_time)
+
+    with tempfile.TemporaryDirectory() as log_dir:
+        flight_recorder = FlightRecorder(os.path.join(log_dir, "flight.npy"), capacity=int(args.duration * 100) + 1000)
+        if args.runtime == "loop":
+            flight_controller.start_sender(args.packet_rate)
+            preview = PreviewDisplay(frame_source, headless=True)
+            autopilot.run_autopilot_loop(flight_controller, velocity_estimator, pid_controller, frame_source, preview,
+                                         velocity_filter=velocity_filter, flight_recorder=flight_recorder,
+                                         frames_to_skip=args.frames_to_skip)
+            flight_controller.stop_sender()
+        else:
+            runtime = ControlRuntime(flight_controller, velocity_estimator, pid_controller, frame_source,
+                                     packet_rate=args.packet_rate, frames_to_skip=args.frames_to_skip, headless=True,
+                                     velocity_filter=velocity_filter, flight_recorder=flight_recorder)
+            asyncio.run(runtime.run())
+        frame_source.stop()
+        simulator.stop()
+        records = np.array(trim_records(flight_recorder.records[:flight_recorder.count]))
+        flight_recorder.close()
+
+    stats = simulator.get_stats()
+    print(f"Packets: {stats['packets_received']} received, {stats['invalid_packets']} invalid, "
+          f"{stats['packet_rate']:.1f} per second, interval jitter p95 {stats['interval_jitter_p95'] * 1000:.1f} ms")
+    roll_changes = list(simulator.roll_changes)
+    print(f"Roll changes received: {len(roll_changes)}, {len(roll_changes) / args.duration:.1f} per second, "
+          f"roll {records['control_roll'].min() if len(records) else 128} to {records['control_roll'].max() if len(records) else 128}")
+    # With the filter the roll is set by the control step at the packet rate rather than by a frame, so the latency
+    # from a frame's capture does not apply
+    latencies = roll_latencies(records, roll_changes) if velocity_filter is None else []
+    if latencies:
+        p50, p95 = np.percentile(latencies, [50, 95]) * 1000
+        print(f"Capture to packet latency: p50 {p50:.0f} ms, p95 {p95:.0f} ms")
+    # How well the drone was held still over the second half of the flight
+    velocity_log = np.array(simulator.velocity_log).reshape(-1, 2)
+    settled = velocity_log[velocity_log[:, 0] >= autopilot_start + args.duration / 2, 1]
+    if len(settled):
+        print(f"Drone velocity over the second half: mean {settled.mean():.1f} px/s, rms {np.sqrt(np.mean(settled ** 2)):.1f} px/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,10 @@
 import socket
 import threading
+import time
+
+import numpy as np
+
+import tracing
 
 class FlightController:
     """
@@ -7,6 +12,8 @@ class FlightController:
     It maintains the current control inputs (turn, accelerator, roll, pitch) and various flags for special modes (fast fly, fast drop, emergency stop, etc.).
     To use this class, an instantiation should be created, and then the set_command_state method can be called to update the control inputs and flags.
     send_control_packet should be called in a loop to continuously send the latest control state to the drone.
+    Alternatively, start_sender starts a thread that sends the latest control state at a fixed rate, independent of how long
+    the rest of the loop takes. The control state can then be updated from any thread with set_command_state.
     The setters, getters, and send_packet methods are all thread-safe, allowing for control state updates and packet sending to happen concurrently.
 
     The loop responsible for sending control packets to the drone should look something like this:
@@ -46,11 +53,25 @@ class FlightController:
         self.control_packet_ip =  "192.168.1.1"
         self.control_packet_port = 7099
 
-    def construct_packet(self):
+        # State used by the sender thread. The packet is only rebuilt when the command state changes.
+        self._packet = bytearray(9)
+        self._state_version = 0
+        self._packet_version = -1
+        self._sender_thread = None
+        self._sender_running = False
+        # Send jitter (seconds after the deadline) of the last len(self._jitter) packets, and counters since start_sender.
+        self._jitter = np.zeros(1000)
+        self.packets_sent = 0
+        self.missed_deadlines = 0
+
+    def construct_packet(self, packet=None):
         """
         A helper function used to construct a packet from the current control state.
+
+        :param packet: Optional 9 byte bytearray to write the packet into instead of allocating a new one.
         """
-        packet = bytearray(9)
+        if packet is None:
+            packet = bytearray(9)
         with self._lock:
             flags = 0
             if self.is_fast_fly:
@@ -130,6 +151,7 @@ class FlightController:
         :param is_gyro_correction: Set to true to enable gyro correction (meant to be set briefly before takeoff)
         """
         with self._lock:
+            old_state = self._command_state()
             if control_turn is not None:
                 self.control_turn = control_turn
             if control_accelerator is not None:
@@ -145,11 +167,17 @@ class FlightController:
             self.is_circle_turn_end = is_circle_turn_end
             self.is_no_head_mode = is_no_head_mode
             self.is_gyro_correction = is_gyro_correction
+            # The sender only rebuilds the packet when the state has actually changed
+            if self._command_state() != old_state:
+                self._state_version += 1
 
     def get_command_state(self):
         with self._lock:
-            return (self.control_turn, self.control_accelerator, self.control_roll, self.control_pitch,
-                    self.is_fast_fly, self.is_fast_drop, self.is_emergency_stop, self.is_circle_turn_end, self.is_no_head_mode, self.is_gyro_correction)
+            return self._command_state()
+
+    def _command_state(self):
+        return (self.control_turn, self.control_accelerator, self.control_roll, self.control_pitch,
+                self.is_fast_fly, self.is_fast_drop, self.is_emergency_stop, self.is_circle_turn_end, self.is_no_head_mode, self.is_gyro_correction)
 
     def get_trims(self):
         return (self.control_turn_center, self.control_accelerator_center,
@@ -166,4 +194,69 @@ class FlightController:
 
     def send_control_packet(self):
         packet = self.construct_packet()
-        self.sock.sendto(packet, (self.control_packet_ip, self.control_packet_port)) 
+        self.sock.sendto(packet, (self.control_packet_ip, self.control_packet_port))
+
+    def latest_packet(self):
+        """
+        Returns the packet for the current control state. The packet is a preallocated buffer that is only rebuilt when
+        the state has changed since the last call, so it is overwritten by the next call and should be sent right away.
+        Meant for a single sending thread or task, such as the sender thread.
+        """
+        version = self._state_version
+        if version != self._packet_version:
+            self._packet_version = version
+            self.construct_packet(self._packet)
+        return self._packet
+
+    def start_sender(self, rate_hz=20):
+        """
+        Starts a thread that sends the latest control state to the drone at a fixed rate.
+        Deadlines are scheduled on the monotonic clock, so a late packet does not push back the ones after it.
+
+        :param rate_hz: Packets sent per second.
+        """
+        if self._sender_thread is not None:
+            return
+        self.packets_sent = 0
+        self.missed_deadlines = 0
+        self._sender_running = True
+        self._sender_thread = threading.Thread(target=self._sender_loop, args=(1.0 / rate_hz,), daemon=True)
+        self._sender_thread.start()
+
+    def stop_sender(self):
+        if self._sender_thread is None:
+            return
+        self._sender_running = False
+        self._sender_thread.join()
+        self._sender_thread = None
+
+    def _sender_loop(self, period):
+        deadline = time.monotonic()
+        while self._sender_running:
+            now = time.monotonic()
+            if now < deadline:
+                time.sleep(deadline - now)
+                now = time.monotonic()
+
+            with tracing.span("send_packet"):
+                self.sock.sendto(self.latest_packet(), (self.control_packet_ip, self.control_packet_port))
+            self._jitter[self.packets_sent % len(self._jitter)] = now - deadline
+            self.packets_sent += 1
+
+            deadline += period
+            # If whole periods were lost (e.g. the GIL was held), skip the missed deadlines instead of sending a burst.
+            missed = int((time.monotonic() - deadline) // period)
+            if missed > 0:
+                self.missed_deadlines += missed
+                deadline += missed * period
+
+    def get_sender_stats(self):
+        """
+        Returns: dict with the number of packets sent and missed deadlines since start_sender, and the mean, 95th percentile
+                 and max send jitter in seconds over the last (up to 1000) packets.
+        """
+        jitter = self._jitter[:min(self.packets_sent, len(self._jitter))]
+        if len(jitter) == 0:
+            return {"packets_sent": 0, "missed_deadlines": self.missed_deadlines, "jitter_mean": 0.0, "jitter_p95": 0.0, "jitter_max": 0.0}
+        return {"packets_sent": self.packets_sent, "missed_deadlines": self.missed_deadlines,
+                "jitter_mean": float(jitter.mean()), "jitter_p95": float(np.percentile(jitter, 95)), "jitter_max": float(jitter.max())}
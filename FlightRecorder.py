@@ -0,0 +1,121 @@
+import argparse
+import glob
+import time
+
+import numpy as np
+
+# Binary flight data recorder. Every record is one row of a NumPy structured array in a .npy file that is memory mapped
+# and preallocated for the whole flight, so logging a record is a single row assignment with no allocation, formatting
+# or file write in the loop; the operating system writes the pages in the background.
+# The files are plain .npy files, so np.load(path, mmap_mode="r") opens them without reading them into memory.
+#
+# Analysis:
+#   python FlightRecorder.py flights/*.npy
+#   flights = load_flights("flights/*.npy") # {path: structured array view of the recorded rows}
+
+RECORD_DTYPE = np.dtype([
+    ("time", "f8"), # time.monotonic() when the record was logged
+    ("capture_time", "f8"), # time.monotonic() capture time of the frame the velocity was estimated from
+    ("seq", "i8"), # Frame sequence number from FrameSource
+    ("velocity", "f4"), # NaN if the estimate failed
+    ("variance", "f4"),
+    ("inliers", "i4"), # Matches, tracks or flow samples the velocity was estimated from
+    ("p_term", "f4"), ("i_term", "f4"), ("d_term", "f4"),
+    ("control_turn", "i2"), ("control_accelerator", "i2"), ("control_roll", "i2"), ("control_pitch", "i2"),
+    ("is_fast_fly", "?"), ("is_fast_drop", "?"), ("is_emergency_stop", "?"),
+    ("is_circle_turn_end", "?"), ("is_no_head_mode", "?"), ("is_gyro_correction", "?"),
+    ("packet", "u1", (9,)), # Control packet for the command state, as sent by the FlightController
+])
+
+
+class FlightRecorder:
+    """
+    Appends fixed size records (RECORD_DTYPE) to a preallocated memory mapped file.
+    When the file is full, further records are counted in self.records_dropped instead of being written.
+    """
+    def __init__(self, path, capacity=360000):
+        """
+        :param path: .npy file to create.
+        :param capacity: Maximum number of records, 360000 is an hour at 100 records per second (about 29 MB).
+        """
+        self.path = path
+        self.records = np.lib.format.open_memmap(path, mode="w+", dtype=RECORD_DTYPE, shape=(capacity,))
+        self.count = 0
+        self.records_dropped = 0
+        self._packet = bytearray(9)
+
+    def log(self, flight_controller, pid_controller, seq=-1, capture_time=np.nan, velocity=None, variance=None, inliers=-1):
+        """
+        Records the current state of the loop: the estimate, the PID terms of the last update and the command state and
+        packet of the flight controller. seq, capture_time, velocity, variance and inliers should all describe the same
+        frame; a missing velocity or variance is recorded as NaN.
+        """
+        if self.count >= len(self.records):
+            self.records_dropped += 1
+            return
+        # Built into a buffer of its own, the sender thread owns the flight controller's packet buffer
+        flight_controller.construct_packet(self._packet)
+        self.records[self.count] = (time.monotonic(), capture_time, seq, np.nan if velocity is None else velocity,
+                                    np.nan if variance is None else variance,
+                                    inliers, pid_controller.p_term, pid_controller.i_term, pid_controller.d_term,
+                                    *flight_controller.get_command_state(), tuple(self._packet))
+        self.count += 1
+
+    def close(self):
+        self.records.flush()
+        del self.records
+
+
+def trim_records(records):
+    """
+    Returns: the recorded rows of a log, dropping the unused preallocated rows at its end (their time is 0).
+    """
+    used = np.flatnonzero(records["time"] != 0)
+    return records[:used[-1] + 1] if len(used) else records[:0]
+
+
+def load_flights(pattern):
+    """
+    Opens every log matching the glob pattern without reading it into memory.
+
+    Returns: dict of path -> structured array (a view of the memory mapped file) of the recorded rows.
+    """
+    return {path: trim_records(np.load(path, mmap_mode="r")) for path in sorted(glob.glob(pattern))}
+
+
+def summarize(records):
+    """
+    Returns: dict of summary statistics of one flight.
+    """
+    if len(records) == 0:
+        return {"records": 0}
+    duration = float(records["time"][-1] - records["time"][0])
+    velocity = records["velocity"]
+    valid = np.isfinite(velocity)
+    # Latency from the capture of the frame to the record being logged, i.e. to the command being set
+    latency = (records["time"] - records["capture_time"])[np.isfinite(records["capture_time"])]
+    return {
+        "records": len(records),
+        "duration_s": duration,
+        "rate_hz": (len(records) - 1) / duration if duration > 0 else 0.0,
+        "failed_estimates": float(1.0 - valid.mean()),
+        "velocity_mean": float(velocity[valid].mean()) if valid.any() else float("nan"),
+        "velocity_std": float(velocity[valid].std()) if valid.any() else float("nan"),
+        "roll_min": int(records["control_roll"].min()),
+        "roll_max": int(records["control_roll"].max()),
+        "latency_p50_ms": float(np.median(latency) * 1000) if len(latency) else float("nan"),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarizes flight data recorder logs.")
+    parser.add_argument("logs", nargs="+", help="Log files or glob patterns, e.g. flights/*.npy")
+    args = parser.parse_args()
+
+    for pattern in args.logs:
+        for path, records in load_flights(pattern).items():
+            print(path, summarize(records))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import queue
+import threading
+
+import cv2
+
+import tracing
+
+
+class FrameRecorder:
+    """
+    Records frames to a video file on a background thread, so recording does not slow down the frame pipeline.
+    Frames are handed over through a bounded queue, and when the writer falls behind new frames are dropped instead of
+    blocking the caller. The number of dropped frames is in self.frames_dropped.
+
+    Pass it to FrameSource as recorder=FrameRecorder(...) to record every decoded frame while flying. This re-encodes the
+    frames; to save the drone's stream as it is, without re-encoding, use FFmpegCapture(..., record_path=...) instead.
+    """
+    def __init__(self, path, fps=20, fourcc="mp4v", queue_size=32, copy_frames=False):
+        """
+        :param path: Output video file.
+        :param fps: Frame rate written to the file. The drone streams at about 20 frames per second.
+        :param queue_size: Frames waiting to be written before new ones are dropped.
+        :param copy_frames: Copy each frame before queueing it. Needed for sources that reuse their arrays, such as
+                            FFmpegCapture, and turned on by FrameSource for those sources.
+        """
+        self.path = path
+        self.fps = fps
+        self.fourcc = cv2.VideoWriter_fourcc(*fourcc)
+        self.copy_frames = copy_frames
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._writer = None
+        self._thread = None
+        self.frames_written = 0
+        self.frames_dropped = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._write_loop, name="recorder", daemon=True)
+        self._thread.start()
+        return self
+
+    def submit(self, frame):
+        """
+        Queues a frame for writing without waiting.
+
+        Returns: True if the frame was queued, False if it was dropped because the queue is full.
+        """
+        try:
+            self._queue.put_nowait(frame.copy() if self.copy_frames else frame)
+            return True
+        except queue.Full:
+            self.frames_dropped += 1
+            return False
+
+    def stop(self):
+        """
+        Writes the frames still in the queue and closes the file.
+        """
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def _write_loop(self):
+        while True:
+            frame = self._queue.get()
+            if frame is None:
+                break
+            if self._writer is None:
+                # The size is only known once the first frame arrives
+                height, width = frame.shape[:2]
+                self._writer = cv2.VideoWriter(self.path, self.fourcc, self.fps, (width, height), isColor=frame.ndim == 3)
+            with tracing.span("record"):
+                self._writer.write(frame)
+            self.frames_written += 1
+        if self._writer is not None:
+            self._writer.release()
+            self._writer = None
@@ -0,0 +1,418 @@
+import os
+import subprocess
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import tracing
+
+
+def random_texture(width, height, seed=0):
+    """
+    Makes a BGR texture with corners at many scales for the synthetic sources: smooth random blobs with filled circles on top.
+    """
+    rng = np.random.default_rng(seed)
+    texture = rng.integers(0, 256, (height // 8, width // 8, 3), dtype=np.uint8)
+    texture = cv2.resize(texture, (width, height), interpolation=cv2.INTER_CUBIC)
+    for _ in range(width * height // 4000):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        cv2.circle(texture, center, int(rng.integers(3, 30)), color, -1)
+    return texture
+
+
+class SyntheticCapture:
+    """
+    Stands in for cv2.VideoCapture with a generated scene, so the pipeline can run without the drone or a recording.
+    The camera pans over a random texture at a constant velocity, bouncing off the edges of the texture.
+    Only the parts of the VideoCapture interface used by FrameSource are implemented.
+    """
+    def __init__(self, width=640, height=480, fps=20, velocity=(2.0, 0.0), seed=0):
+        """
+        :param velocity: (x, y) pan of the camera in pixels per frame. The scene moves the opposite way in the image.
+        """
+        self.width, self.height = width, height
+        self.fps = fps
+        self.velocity = np.array(velocity, dtype=np.float64)
+
+        self.texture = random_texture(width * 2, height * 2, seed)
+        self.position = np.array([width / 2, height / 2])
+        self.opened = True
+
+    def isOpened(self):
+        return self.opened
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.width
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.height
+        return 0
+
+    def read(self):
+        if not self.opened:
+            return False, None
+        limit = np.array([self.texture.shape[1] - self.width, self.texture.shape[0] - self.height])
+        self.position += self.velocity
+        # Bounce off the edges of the texture
+        for axis in range(2):
+            if self.position[axis] < 0 or self.position[axis] > limit[axis]:
+                self.velocity[axis] = -self.velocity[axis]
+                self.position[axis] = np.clip(self.position[axis], 0, limit[axis])
+        x, y = int(round(self.position[0])), int(round(self.position[1]))
+        return True, self.texture[y:y + self.height, x:x + self.width].copy()
+
+    def release(self):
+        self.opened = False
+
+
+class GroundTruthCapture:
+    """
+    Stands in for cv2.VideoCapture with frames of known motion, for measuring the accuracy of the velocity estimators.
+    Every frame is the previous one moved by a similarity transform about the image center: a sub-pixel translation,
+    a rotation (yaw, as seen by a camera looking down) and a scale change (altitude). Sensor noise, blur and brightness
+    flicker can be added on top. The motion between the last two frames read is in self.motion.
+
+    The scene is a texture warped with cv2.warpAffine and wrapped at its edges, so the whole frame always moves as one
+    and the ground truth holds for every pixel. Runs are reproducible for a given seed.
+    """
+    def __init__(self, texture=None, width=640, height=480, fps=20, translation=(2.0, 0.0), rotation=0.0, scale=1.0,
+                 jitter=0.0, noise=0.0, blur=0.0, flicker=0.0, seed=0):
+        """
+        :param texture: BGR image of the scene, or None for a random texture.
+        :param translation: (x, y) motion of the scene in the image, in pixels per frame.
+        :param rotation: Rotation of the scene in degrees per frame.
+        :param scale: Scale change per frame, e.g. 1.01 for the scene growing 1% per frame.
+        :param jitter: Standard deviation of a random change of the translation per frame, in pixels.
+        :param noise: Standard deviation of the added Gaussian noise, in gray levels.
+        :param blur: Sigma of the Gaussian blur in pixels, 0 for none.
+        :param flicker: Brightness of each frame is scaled by a random gain in [1 - flicker, 1 + flicker].
+        """
+        self.width, self.height = width, height
+        self.fps = fps
+        self.texture = texture if texture is not None else random_texture(width * 2, height * 2, seed)
+        self.translation = np.array(translation, dtype=np.float64)
+        self.rotation, self.scale = rotation, scale
+        self.jitter, self.noise, self.blur, self.flicker = jitter, noise, blur, flicker
+        self.rng = np.random.default_rng(seed)
+
+        # Maps texture coordinates to frame coordinates, starting with the texture centered in the frame
+        texture_h, texture_w = self.texture.shape[:2]
+        self.transform = np.array([[1.0, 0.0, (width - texture_w) / 2], [0.0, 1.0, (height - texture_h) / 2], [0.0, 0.0, 1.0]])
+        self.motion = None
+        self.opened = True
+
+    def isOpened(self):
+        return self.opened
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.width
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.height
+        return 0
+
+    def read(self):
+        if not self.opened:
+            return False, None
+        if self.motion is None:
+            # The first frame has no motion before it
+            self.motion = {"dx": 0.0, "dy": 0.0, "rotation": 0.0, "scale": 1.0}
+        else:
+            dx, dy = self.translation + self.rng.normal(0.0, self.jitter, 2) if self.jitter else self.translation
+            center = (self.width / 2, self.height / 2)
+            step = np.vstack([cv2.getRotationMatrix2D(center, self.rotation, self.scale), [0.0, 0.0, 1.0]])
+            step[:2, 2] += (dx, dy)
+            self.transform = step @ self.transform
+            # Rotation and scaling are about the center, so the mean displacement of the frame's pixels is (dx, dy).
+            self.motion = {"dx": float(dx), "dy": float(dy), "rotation": self.rotation, "scale": self.scale}
+
+        frame = cv2.warpAffine(self.texture, self.transform[:2], (self.width, self.height),
+                               flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_WRAP)
+        if self.blur:
+            frame = cv2.GaussianBlur(frame, (0, 0), self.blur)
+        if self.noise or self.flicker:
+            gain = 1.0 + self.rng.uniform(-self.flicker, self.flicker) if self.flicker else 1.0
+            frame = frame * np.float32(gain)
+            if self.noise:
+                frame += self.rng.normal(0.0, self.noise, frame.shape).astype(np.float32)
+            frame = np.clip(frame, 0, 255).astype(np.uint8)
+        return True, frame
+
+    def release(self):
+        self.opened = False
+
+
+class FFmpegCapture:
+    """
+    Optional capture backend that decodes with a local ffmpeg process instead of cv2.VideoCapture.
+    ffmpeg scales the frames and converts them to grayscale inside the decoder, with its low latency flags set, and the
+    raw frames are read with readinto straight into a pool of preallocated NumPy arrays. This skips the full resolution
+    BGR frame, its copies and the resize that VideoCapture + Preprocessor would otherwise do on every frame.
+
+    Works with the RTSP url or any local video file. Only the parts of the VideoCapture interface used by FrameSource
+    are implemented. With record_path, the same ffmpeg process also saves the source's compressed video stream as it is
+    (no re-encoding, at full resolution) to a file, so the flight can be recorded without a second connection. The arrays in the pool are reused, so a frame is only valid for the next pool_size - 1 reads. The
+    pool must therefore be larger than the FrameSource ring_size plus the frames a consumer holds on to. The Preprocessor
+    copies every frame, and FrameSource makes a FrameRecorder copy the frames it queues, so neither holds on to one.
+    """
+    reuses_frames = True
+    def __init__(self, source, resolution=(320, 240), gray=True, fps=0, pool_size=16, ffmpeg_path="ffmpeg", record_path=None):
+        """
+        :param source: RTSP url or video file path.
+        :param resolution: (width, height) ffmpeg scales the frames to. Use the estimator's working resolution.
+        :param gray: Output grayscale frames. If False, BGR frames are output.
+        :param fps: Frame rate reported to FrameSource for pacing files. 0 means unpaced.
+        :param ffmpeg_path: ffmpeg executable.
+        :param record_path: Optional file to save the original stream to. Use .mkv, which stays readable if the
+                            recording is cut short.
+        """
+        self.width, self.height = resolution
+        self.fps = fps
+        self.source = source
+        self.is_stream = "://" in source
+        channels = 1 if gray else 3
+        shape = (self.height, self.width) if gray else (self.height, self.width, 3)
+        self.frame_size = self.width * self.height * channels
+        self.pool = [np.empty(shape, dtype=np.uint8) for _ in range(pool_size)]
+        self._next = 0
+
+        self.ffmpeg_path = ffmpeg_path
+        self.gray = gray
+        self.record_path = record_path
+        self.reopen_count = 0
+        self.process = None
+        self._open(record_path)
+
+    def _open(self, record_path):
+        command = [self.ffmpeg_path, "-nostdin", "-loglevel", "error"]
+        if self.is_stream:
+            # Start decoding immediately and do not buffer frames in the demuxer or decoder
+            command += ["-fflags", "nobuffer", "-flags", "low_delay", "-probesize", "32", "-analyzeduration", "0"]
+        command += ["-i", self.source, "-an",
+                    "-vf", f"scale={self.width}:{self.height}:flags=area",
+                    "-pix_fmt", "gray" if self.gray else "bgr24", "-f", "rawvideo", "pipe:1"]
+        if record_path is not None:
+            # Second output of the same decode: the video packets are copied into the file without decoding them
+            command += ["-map", "0:v", "-c:v", "copy", "-y", record_path]
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=self.frame_size)
+
+    def reopen(self):
+        """
+        Restarts ffmpeg after the stream was lost. The recording continues in a new file, e.g. flight_1.mkv after
+        flight.mkv, since ffmpeg would otherwise overwrite it.
+        """
+        self.release()
+        self.reopen_count += 1
+        record_path = None
+        if self.record_path is not None:
+            stem, extension = os.path.splitext(self.record_path)
+            record_path = f"{stem}_{self.reopen_count}{extension}"
+        self._open(record_path)
+
+    def isOpened(self):
+        return self.process is not None and self.process.poll() is None
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.width
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.height
+        return 0
+
+    def read(self):
+        if self.process is None:
+            return False, None
+        frame = self.pool[self._next]
+        view = memoryview(frame.reshape(-1))
+        received = 0
+        while received < self.frame_size:
+            n = self.process.stdout.readinto(view[received:])
+            if not n:
+                return False, None
+            received += n
+        self._next = (self._next + 1) % len(self.pool)
+        return True, frame
+
+    def release(self):
+        if self.process is None:
+            return
+        # ffmpeg finishes writing the recording when it is terminated, so only kill it if it does not exit
+        self.process.terminate()
+        self.process.stdout.close()
+        try:
+            self.process.wait(timeout=2.0)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+
+class FrameSource:
+    """
+    Decodes frames on its own thread and publishes them into a small ring buffer, tagged with a sequence number and the
+    time.monotonic() time they were captured. Consumers never block the decoder: they pick up the latest frame, wait for
+    a frame newer than one they already have, or ask for a frame a fixed number of frames (stride) after one they have.
+
+    The source can be the drone's RTSP url, a recorded video file, or an object with the read() and release() methods of
+    cv2.VideoCapture such as SyntheticCapture.
+
+    With cv2.VideoCapture every published frame is a new array, so a consumer can keep using a frame after the decoder has
+    moved on. FFmpegCapture reuses a pool of arrays instead, see its docstring.
+    Frames are returned as (seq, timestamp, frame) tuples, or None if there is no such frame (or the source has ended).
+    A file ends at its first failed read. A stream is reopened instead, so the feed comes back after a dropout.
+    """
+    def __init__(self, source, ring_size=8, realtime=None, recorder=None, reconnect_delay=0.5):
+        """
+        :param source: RTSP url, video file path, or a VideoCapture-like object such as FFmpegCapture or SyntheticCapture.
+        :param ring_size: Number of recent frames kept.
+        :param recorder: Optional FrameRecorder every decoded frame is handed to. It is started and stopped with the FrameSource.
+        :param realtime: If True, the decoder runs freely and old frames are dropped, as with a live camera.
+                         Files and synthetic sources are paced to their frame rate.
+                         If False, the decoder waits for consumers so no frame is dropped, for offline processing.
+                         Defaults to True for urls and False otherwise.
+        :param reconnect_delay: Seconds to wait after a failed read of a stream before reopening it.
+        """
+        self.source = source
+        if isinstance(source, str):
+            self.cap = cv2.VideoCapture(source)
+            self.is_stream = "://" in source
+        else:
+            self.cap = source
+            self.is_stream = getattr(source, "is_stream", False)
+        self.realtime = self.is_stream if realtime is None else realtime
+        self.reconnect_delay = reconnect_delay
+        self.reconnects = 0
+        # Live streams are already paced by the camera
+        fps = self.cap.get(cv2.CAP_PROP_FPS)
+        self.frame_period = 1.0 / fps if (fps and not self.is_stream) else 0.0
+
+        self.recorder = recorder
+        if recorder is not None and getattr(self.cap, "reuses_frames", False):
+            # The recorder's queue holds on to frames, which the source would overwrite before they are written
+            recorder.copy_frames = True
+        self._ring = [None] * ring_size
+        self._latest_seq = -1
+        self._consumed_seq = -1
+        self._new_frame = threading.Condition()
+        self._running = False
+        self._thread = None
+        self.finished = False
+
+    def start(self):
+        if self.recorder is not None:
+            self.recorder.start()
+        self._running = True
+        self._thread = threading.Thread(target=self._decode_loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        with self._new_frame:
+            self._new_frame.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.cap.release()
+        if self.recorder is not None:
+            self.recorder.stop()
+
+    def _decode_loop(self):
+        next_frame_time = time.monotonic()
+        while self._running:
+            if not self.realtime:
+                # Wait for the consumer instead of overwriting frames it has not seen
+                with self._new_frame:
+                    while self._running and self._latest_seq - self._consumed_seq >= len(self._ring):
+                        self._new_frame.wait(0.1)
+            elif self.frame_period:
+                next_frame_time += self.frame_period
+                delay = next_frame_time - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+            with tracing.span("decode"):
+                ret, frame = self.cap.read()
+            timestamp = time.monotonic()
+            if not ret:
+                if not self.is_stream:
+                    break
+                self._reconnect()
+                continue
+
+            seq = self._latest_seq + 1
+            self._ring[seq % len(self._ring)] = (seq, timestamp, frame)
+            with self._new_frame:
+                self._latest_seq = seq
+                self._new_frame.notify_all()
+            if self.recorder is not None:
+                self.recorder.submit(frame)
+
+        with self._new_frame:
+            self.finished = True
+            self._new_frame.notify_all()
+
+    def _reconnect(self):
+        # A dropout of the drone's wifi or a stalled RTSP session fails the read, but the stream comes back
+        with self._new_frame:
+            self._new_frame.wait_for(lambda: not self._running, self.reconnect_delay)
+        if not self._running:
+            return
+        print("Lost the video stream, reconnecting")
+        self.reconnects += 1
+        if isinstance(self.source, str):
+            self.cap.release()
+            self.cap = cv2.VideoCapture(self.source)
+        elif hasattr(self.cap, "reopen"):
+            self.cap.reopen()
+
+    def _get(self, seq):
+        entry = self._ring[seq % len(self._ring)]
+        # The slot may already hold a newer frame if the consumer fell behind
+        if entry is None or entry[0] != seq:
+            return None
+        self._consumed_seq = max(self._consumed_seq, seq)
+        return entry
+
+    def latest(self):
+        """
+        Returns: the newest frame, without waiting.
+        """
+        seq = self._latest_seq
+        if seq < 0:
+            return None
+        return self._get(seq) or self._get(self._latest_seq)
+
+    def latest_newer_than(self, seq, timeout=None):
+        """
+        Waits until a frame newer than seq has been decoded and returns the newest frame.
+        Use seq=-1 to wait for the first frame.
+        """
+        with self._new_frame:
+            if not self._new_frame.wait_for(lambda: self._latest_seq > seq or self.finished or not self._running, timeout):
+                return None
+            if self._latest_seq <= seq:
+                return None
+        return self.latest()
+
+    def frame_at_stride(self, seq, stride, timeout=None):
+        """
+        Waits for the frame stride frames after seq and returns it.
+        If the consumer has fallen so far behind that the frame is no longer in the ring buffer, the newest frame is returned.
+        """
+        target = seq + stride
+        with self._new_frame:
+            if not self._new_frame.wait_for(lambda: self._latest_seq >= target or self.finished or not self._running, timeout):
+                return None
+            if self._latest_seq < target:
+                return None
+        return self._get(target) or self.latest()
@@ -1,48 +1,114 @@
 # PIDController generated by claude
 import time
+from collections import deque
 
 class PIDController:
-    def __init__(self, kp, ki, kd, setpoint=0):
+    def __init__(self, kp, ki, kd, setpoint=0, output_limits=None, plant_gain=None, history_length=64):
+        """
+        :param output_limits: Optional (min, max) the output is clamped to, e.g. (-127, 127) for trim = 128 - output
+                              to stay within the 1-255 range of the control packet. The integral stops growing while the
+                              output is saturated (anti-windup).
+        :param plant_gain: Enables delay compensation. The change in velocity per second per unit of output, e.g. the
+                           force_coefficient of the drone model in test_PID.py. Measurements passed with a timestamp
+                           are predicted forward to the current time using the outputs applied since they were captured,
+                           taking the integral term as the output that holds the drone still.
+        :param history_length: Number of recent outputs kept for the delay compensation.
+        """
         self.kp = kp  # Proportional gain
         self.ki = ki  # Integral gain
         self.kd = kd  # Derivative gain
-        
+
         self.setpoint = setpoint  # Target value (e.g., 0 = centered)
-        
+        self.output_limits = output_limits
+        self.plant_gain = plant_gain
+
         self.previous_error = 0
         self.integral = 0
         self.last_time = time.time()
-    
-    def update(self, current_value):
-        """Calculate control output based on current measurement"""
-        current_time = time.time()
-        dt = current_time - self.last_time
-        
+        # Capture time of the last measurement passed with a timestamp, see update
+        self.last_timestamp = None
+        # (time.monotonic() time, output - integral term) of the recent outputs, for the delay compensation
+        self.output_history = deque(maxlen=history_length)
+        # Terms of the last update, for logging
+        self.p_term = self.i_term = self.d_term = 0.0
+
+    def update(self, current_value, dt=None, timestamp=None, now=None):
+        """
+        Calculate control output based on current measurement.
+        dt is the time since the last update. If it is None, the wall-clock time since the last update is used.
+        Pass it explicitly to run the controller in a simulation faster than real time.
+
+        timestamp is the time.monotonic() capture time of the frame the measurement was made on, e.g. from FrameSource.
+        If it is given, dt is the time between the capture of this and the previous measurement, so the integral and
+        derivative follow the camera's timeline rather than the time the measurements arrive. With plant_gain set, the
+        measurement is also predicted forward to now (time.monotonic() by default) to make up for the vision latency.
+        """
+        if timestamp is not None:
+            dt = timestamp - self.last_timestamp if self.last_timestamp is not None else 0.0
+            if self.plant_gain is not None:
+                now = time.monotonic() if now is None else now
+                # The velocity was measured between the previous frame and this one, so it describes the middle of that interval.
+                current_value += self.plant_gain * self._integrate_outputs(timestamp - dt / 2, now)
+            self.last_timestamp = timestamp
+        elif dt is None:
+            current_time = time.time()
+            dt = current_time - self.last_time
+            self.last_time = current_time
+
         # Calculate error
         error = self.setpoint - current_value
-        
+
         # Proportional term
         p_term = self.kp * error
-        
+
         # Integral term (accumulated error)
+        previous_integral = self.integral
         self.integral += error * dt
         i_term = self.ki * self.integral
-        
+
         # Derivative term (rate of change)
         derivative = (error - self.previous_error) / dt if dt > 0 else 0
         d_term = self.kd * derivative
-        
+
         # Store for next iteration
         self.previous_error = error
-        self.last_time = current_time
-        
+
         # Combined output
         output = p_term + i_term + d_term
-        
+
+        if self.output_limits is not None:
+            low, high = self.output_limits
+            if (output > high and error * self.ki > 0) or (output < low and error * self.ki < 0):
+                # Saturated and the error pushes further into saturation: stop integrating so the integral does not wind up
+                self.integral = previous_integral
+                i_term = self.ki * self.integral
+                output = p_term + i_term + d_term
+            output = min(max(output, low), high)
+
+        self.p_term, self.i_term, self.d_term = p_term, i_term, d_term
+        if self.plant_gain is not None:
+            # The integral term settles at the output that balances the drone, so only the rest of the output accelerates it.
+            self.output_history.append((time.monotonic() if now is None else now, output - i_term))
+
         return output
-    
+
+    def _integrate_outputs(self, start, end):
+        """
+        Returns: the integral of the recorded outputs over [start, end], taking each as held until the next one.
+        """
+        total = 0.0
+        history = self.output_history
+        for i, (applied_time, output) in enumerate(history):
+            until = history[i + 1][0] if i + 1 < len(history) else end
+            overlap = min(until, end) - max(applied_time, start)
+            if overlap > 0:
+                total += output * overlap
+        return total
+
     def reset(self):
         """Reset integral and derivative terms"""
         self.integral = 0
         self.previous_error = 0
-        self.last_time = time.time()
\ No newline at end of file
+        self.last_time = time.time()
+        self.last_timestamp = None
+        self.output_history.clear()
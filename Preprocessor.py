@@ -0,0 +1,69 @@
+import time
+import cv2
+import numpy as np
+
+import tracing
+
+
+class Preprocessor:
+    """
+    Prepares camera frames for the velocity estimators: resizes to the working resolution once, converts to grayscale
+    once into a preallocated buffer, and optionally crops a region of interest.
+    It also builds the camera intrinsics K for the working resolution (and crop), so the feature pixel coordinates and
+    K always describe the same image. Changing resolution is then the only setting needed to trade accuracy for latency.
+
+    The returned image is a view into one of two buffers that are used in turn, so it stays valid until the call after
+    next. This lets an estimator keep the previous frame without copying it. Frames that are already grayscale at the
+    working resolution are copied into the buffer too, since their source may reuse the array (FFmpegCapture's pool).
+    """
+    def __init__(self, resolution=(320, 240), roi=None, focal_length=450, native_width=640):
+        """
+        :param resolution: (width, height) of the working image.
+        :param roi: Optional (x, y, width, height) crop, in working resolution pixels.
+        :param focal_length: Focal length in pixels of a native_width wide frame. It is scaled to the working resolution
+                             so the normalized displacements (and therefore the PID gains) do not depend on resolution.
+        :param native_width: Width of the camera frames focal_length was chosen for. The drone streams 640x480.
+        """
+        self.W, self.H = resolution
+        self.roi = roi
+        self.F = focal_length * self.W / native_width
+
+        cx, cy = self.W / 2, self.H / 2
+        if self.roi is not None:
+            cx -= self.roi[0]
+            cy -= self.roi[1]
+        self.K = np.array([[self.F, 0, cx], [0, self.F, cy], [0, 0, 1]])
+
+        self._resized = np.empty((self.H, self.W, 3), dtype=np.uint8)
+        self._gray = [np.empty((self.H, self.W), dtype=np.uint8) for _ in range(2)]
+        self._next = 0
+        self.timings = {}
+
+    def process(self, img):
+        """
+        :param img: BGR or grayscale frame at any resolution.
+        Returns: grayscale image at the working resolution, cropped to the roi if one is set.
+        """
+        start_time = time.perf_counter()
+        gray = self._gray[self._next]
+        self._next = 1 - self._next
+
+        needs_resize = img.shape[0] != self.H or img.shape[1] != self.W
+        if img.ndim == 3:
+            if needs_resize:
+                img = cv2.resize(img, (self.W, self.H), dst=self._resized, interpolation=cv2.INTER_AREA)
+            cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=gray)
+        elif needs_resize:
+            cv2.resize(img, (self.W, self.H), dst=gray, interpolation=cv2.INTER_AREA)
+        else:
+            # Already grayscale at the working resolution (e.g. from FFmpegCapture). The estimator keeps this frame as its
+            # previous frame, and FFmpegCapture overwrites its arrays after pool_size frames, so it is copied.
+            np.copyto(gray, img)
+
+        if self.roi is not None:
+            x, y, w, h = self.roi
+            gray = gray[y:y + h, x:x + w]
+        end_time = time.perf_counter()
+        self.timings["preprocess"] = end_time - start_time
+        tracing.record("preprocess", start_time, end_time)
+        return gray
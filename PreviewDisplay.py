@@ -0,0 +1,114 @@
+import numbers
+import threading
+import time
+
+import cv2
+
+import tracing
+
+
+class PreviewDisplay:
+    """
+    Shows the drone's video feed outside the control loop. On its own thread, at most rate times per second, it takes
+    the newest frame from a FrameSource by reference, skips it if it was already shown, downscales it and draws the
+    latest status (velocity, trim, timings) on top. The control loop only hands over its status with set_status, which
+    never blocks.
+
+    OpenCV windows have to be used from a single thread, so once start() has been called the window must not be used
+    from any other thread. Without start(), step() can be called from a loop that is already rate limited, such as the
+    preview task of ControlRuntime.
+    With headless=True nothing is created or shown, and every method returns immediately.
+    """
+    def __init__(self, frame_source, window_name="Drone Camera", rate=10, scale=0.5, overlay=True, headless=False):
+        """
+        :param frame_source: FrameSource to show frames from.
+        :param rate: Maximum refreshes per second.
+        :param scale: Size of the preview relative to the frames.
+        :param overlay: Draw the status set with set_status on the preview.
+        :param headless: Disable the preview entirely, e.g. when running without a display.
+        """
+        self.frame_source = frame_source
+        self.window_name = window_name
+        self.period = 1.0 / rate
+        self.scale = scale
+        self.overlay = overlay
+        self.headless = headless
+
+        self.quit_requested = False # Set when q is pressed in the preview window
+        self.frames_shown = 0
+        self._status = {}
+        self._last_seq = -1
+        self._next_refresh = 0.0
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        if self.headless:
+            return self
+        self._running = True
+        self._thread = threading.Thread(target=self._display_loop, name="preview", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        else:
+            self._close_window()
+
+    def set_status(self, **status):
+        """
+        Sets the values drawn on the preview, e.g. set_status(velocity=0.01, trim=130, loop_ms=12.5). Values that are not
+        given keep their last value.
+        """
+        if self.headless:
+            return
+        # Replaced rather than modified, so the display thread never sees a dict being changed
+        self._status = {**self._status, **status}
+
+    def _display_loop(self):
+        while self._running:
+            self.step()
+            time.sleep(max(0.0, self._next_refresh - time.monotonic()))
+        self._close_window()
+
+    def _close_window(self):
+        if self.frames_shown > 0:
+            cv2.destroyWindow(self.window_name)
+
+    def step(self):
+        """
+        Shows the newest frame if the refresh is due and the frame is new.
+        """
+        now = time.monotonic()
+        if self.headless or now < self._next_refresh:
+            return
+        self._next_refresh = max(self._next_refresh + self.period, now)
+
+        frame = self.frame_source.latest()
+        if frame is not None and frame[0] != self._last_seq:
+            with tracing.span("preview"):
+                self._last_seq, capture_time, img = frame
+                if self.scale != 1.0:
+                    img = cv2.resize(img, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_NEAREST)
+                if img.ndim == 2:
+                    img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+                elif self.overlay and self.scale == 1.0:
+                    img = img.copy() # Do not draw on the frame the control loop is using
+                if self.overlay:
+                    self._draw_status(img, now - capture_time)
+                cv2.imshow(self.window_name, img)
+                self.frames_shown += 1
+        if cv2.waitKey(1) & 0xFF == ord('q'):
+            self.quit_requested = True
+
+    def _draw_status(self, img, age):
+        lines = [f"frame age: {age * 1000:.0f} ms"]
+        for name, value in self._status.items():
+            lines.append(f"{name}: {value:.4g}" if isinstance(value, numbers.Real) and not isinstance(value, bool) else f"{name}: {value}")
+        for i, line in enumerate(lines):
+            # A dark outline keeps the text readable on any background
+            cv2.putText(img, line, (5, 15 + 15 * i), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 0, 0), 3, cv2.LINE_AA)
+            cv2.putText(img, line, (5, 15 + 15 * i), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 255, 0), 1, cv2.LINE_AA)
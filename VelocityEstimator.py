@@ -1,74 +1,290 @@
-from extractor import Frame, match_frames
+from extractor import Frame, FeatureExtractor
+from Preprocessor import Preprocessor
+from model_fitting import fit_similarity_least_squares
+import tracing
+import time
 import cv2
 import numpy as np
 
+
+def _farneback(pyr_scale, levels, winsize, iterations, poly_n, poly_sigma):
+    def calc_flow(prev, next, flow):
+        flags = cv2.OPTFLOW_USE_INITIAL_FLOW if flow is not None else 0
+        return cv2.calcOpticalFlowFarneback(prev, next, flow, pyr_scale, levels, winsize, iterations, poly_n, poly_sigma, flags)
+    return calc_flow
+
+
+def _dis(preset):
+    dis = cv2.DISOpticalFlow_create(preset)
+    def calc_flow(prev, next, flow):
+        # DIS refines the flow it is given, and computes it from scratch when given None
+        return dis.calc(prev, next, flow)
+    return calc_flow
+
+
+# Dense optical flow backends: name -> function creating calc_flow(prev, next, flow), which returns the flow from prev
+# to next, starting from flow if it is not None (and may write the result into it).
+FLOW_BACKENDS = {
+    "farneback": lambda: _farneback(0.5, 3, 10, 5, 5, 1.2), # The original settings
+    "farneback_coarse": lambda: _farneback(0.5, 2, 10, 2, 5, 1.1), # Fewer levels and iterations
+    "dis": lambda: _dis(cv2.DISOPTICAL_FLOW_PRESET_FAST), # Dense inverse search
+}
+
+
 class VelocityEstimator:
     """
     This class estimates the drone's velocity based on the video feed from the drone's camera.
-    It has two methods for estimating velocity: feature matching and optical flow.
-    These methods are discussed further in the README.md
+    It has three methods for estimating velocity: feature matching, optical flow and sparse flow.
+    The first two are discussed further in the README.md. Sparse flow tracks the corners of the previous frame with
+    pyramidal Lucas-Kanade instead of detecting and matching new ones, and only re-detects when too few tracks survive.
     """
-    def __init__(self, method='feature_matching'):
+    def __init__(self, method='feature_matching', matcher='brute_force', extractor=None, resolution=(320, 240), roi=None,
+                 flow_backend='farneback', seed_flow=False):
         self.previous_frame = None
         self.method = method
-        # These four parameters are used for the feature matching
+        # Every method works on the same preprocessed frame: resized to resolution, converted to grayscale once and
+        # optionally cropped to roi (x, y, width, height). Lowering resolution is the one setting that trades accuracy for latency.
         # F has not been calculated yet, but should be able to work with PID tuning and tuning the match filtering in the match_frames function.
-        self.W, self.H = 640 // 2,  480 // 2
-        self.F = 450
-        self.K = np.array([[self.F, 0, self.W // 2], [0, self.F, self.H // 2], [0, 0, 1]])
+        # It was tuned on the drone's 640x480 frames, and the preprocessor scales it and K to the working resolution
+        # so the feature coordinates and K describe the same image.
+        self.preprocessor = Preprocessor(resolution, roi, focal_length=450)
+        self.W, self.H = resolution
+        self.F = self.preprocessor.F
+        self.K = self.preprocessor.K
+        # The detector, descriptor and matcher are created once here and reused for every frame.
+        # extractor.timings holds the per-stage timings of the last frame.
+        # matcher selects brute force or grid (spatially indexed) descriptor matching, see FeatureExtractor.
+        # A configured FeatureExtractor can be passed in instead, e.g. for grid detection with an adaptive feature budget.
+        self.extractor = extractor if extractor is not None else FeatureExtractor(matcher=matcher)
+
+        # These parameters are used for the sparse flow
+        self.previous_pts = None
+        self.max_tracks = 400 # Number of corners detected when the tracks are refreshed
+        self.min_tracks = 100 # Re-detect when fewer tracks than this survive
+        self.min_coverage = 0.5 # Re-detect when the tracks cover less than this fraction of the coverage grid cells
+        self.coverage_grid = 4 # The image is split into coverage_grid x coverage_grid cells to measure coverage
+        self.lk_params = dict(winSize=(21, 21), maxLevel=3, criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 30, 0.01))
+
+        # These parameters are used for the dense optical flow
+        # flow_backend selects the dense flow algorithm, one of FLOW_BACKENDS. At 320x240 'farneback' (the settings the
+        # gains were tuned with) takes about 30 ms, 'farneback_coarse' about 20 ms and 'dis' about 2 ms.
+        # With seed_flow the flow of the previous frame pair is the starting estimate for the next one, since the drone's
+        # velocity changes little between frames. It is off by default: the gains were tuned on unseeded flow, and a
+        # seed from a bad frame pair carries its error into the next estimate.
+        if flow_backend not in FLOW_BACKENDS:
+            raise ValueError("Unknown flow backend")
+        self.flow_backend = flow_backend
+        self.calc_flow = FLOW_BACKENDS[flow_backend]()
+        self.seed_flow = seed_flow
+        self.brightness_threshold = 225 # Brighter pixels are likely to be noisy in the optical flow output and are ignored
+        self.flow = None
+        self._flow_buffers = None
+
+        # Timings of the stages run by the estimator itself (flow, track, statistics). See get_timings.
+        self.timings = {}
+        # Variance of the last velocity returned, in the same units squared, for weighting it in a VelocityFilter.
+        # It is the spread of the per-feature (or per-pixel) displacements divided by the number of independent samples.
+        self.variance = None
+        self.inliers = 0 # Matches, tracks or flow vectors the last velocity was estimated from
+        self.min_variance = 1e-8 # Keeps a few perfectly agreeing matches from being trusted absolutely
+        # Full motion of the last frame from the feature matches, see estimate_motion. None when it could not be estimated.
+        self.motion = None
+        self.motion_variance = None
 
         if self.method == "feature_matching":
             self.estimate_velocity = self.estimate_velocity_feature_matching
         elif self.method == "optical_flow":
             self.estimate_velocity = self.estimate_velocity_optical_flow
+        elif self.method == "sparse_flow":
+            self.estimate_velocity = self.estimate_velocity_sparse_flow
         else:
             raise ValueError("Unknown method")
         
     # This method is from the SLAM tutorial by LearnOpenCV: https://learnopencv.com/monocular-slam-in-python/
     def estimate_velocity_feature_matching(self, img):
-        current_frame = Frame(img, self.K)
+        gray = self.preprocessor.process(img)
+        current_frame = Frame(gray, self.K, self.extractor)
 
         if self.previous_frame is None:
             self.previous_frame = current_frame
             return None
         
-        idx1, idx2 = match_frames(self.previous_frame, current_frame) # Match descriptors between the previous and current frame 
-        if idx1 is None:
+        idx1, idx2 = self.extractor.match(self.previous_frame, current_frame) # Match descriptors between the previous and current frame 
+        if idx1 is None or len(idx1) == 0: # The model fit can fail and leave no inliers
+            self.motion = self.motion_variance = None
+            # Match the next frame against this one. Keeping the old frame would let a blank or low-texture frame stick
+            # as the reference forever, and the deltas to an older frame span more than one frame interval anyway.
+            self.previous_frame = current_frame
             return None
         
+        start_time = time.perf_counter()
         control_deltas = current_frame.pts[idx2] - self.previous_frame.pts[idx1] # Get the pixel deltas for the matched features between the previous and current frame
+        velocity = np.mean(control_deltas[..., 0]) # Use the mean of these deltas in the x direction as the velocity estimate for the drone. 
+        self.variance = self._variance_of_mean(control_deltas[..., 0], len(control_deltas))
+        self.inliers = len(control_deltas)
+        self._fit_motion(self.previous_frame.pts[idx1], current_frame.pts[idx2])
         self.previous_frame = current_frame
-        return np.mean(control_deltas[..., 0]) # Use the mean of these deltas in the x direction as the velocity estimate for the drone. 
+        self.timings["statistics"] = time.perf_counter() - start_time
+        return velocity
+
+    def estimate_motion(self, img):
+        """
+        Estimates the full motion of the scene in the image between the previous frame and img from one set of feature
+        matches, so more axes can be held from the same vision pass as roll. Only the feature matching method estimates
+        it; for the other methods this returns None.
+        After estimate_velocity the same estimate is in self.motion and its variances in self.motion_variance.
+
+        The components are image motion. With the drone's forward-facing camera, x is sideways drift (roll) but also
+        any yaw, which turns the scene sideways; y is mostly altitude change (throttle), plus any pitch tilt; scale is
+        forward or backward motion (pitch); and rotation is the camera rolling about its optical axis, not yaw.
+
+        Returns: dict with x and y (translation of the scene at the optical center, divided by the focal length like the
+                 velocity), rotation (in-plane rotation of the scene in radians, counterclockwise in the image) and scale
+                 (size of the scene relative to the previous frame, above 1 when the drone moves forward), or None if
+                 the estimate failed.
+        """
+        self.estimate_velocity(img)
+        return self.motion
+
+    def _fit_motion(self, p1, p2):
+        """
+        Fits rotation, scale and translation to the inlier matches (normalized coordinates, so the optical center is the
+        origin) and sets self.motion and self.motion_variance.
+        """
+        model, variances = fit_similarity_least_squares(p1, p2)
+        scale = float(np.hypot(model[0, 0], model[0, 1])) if model is not None else 0.0
+        if scale <= 1e-6: # The fit collapsed, e.g. onto matches that all point at one spot after a scene change
+            self.motion = self.motion_variance = None
+            return
+        a, b = model[0, 0], model[0, 1]
+        self.motion = {"x": float(model[0, 2]), "y": float(model[1, 2]), "rotation": float(np.arctan2(b, a)), "scale": scale}
+        # Near a scale of 1, a and b have the same variance as the scale and the rotation.
+        var_t, _, var_ab, _ = variances.tolist()
+        self.motion_variance = {"x": max(var_t, self.min_variance), "y": max(var_t, self.min_variance),
+                                "rotation": max(var_ab / (scale * scale), self.min_variance), "scale": max(var_ab, self.min_variance)}
      
     # This method is based on the tutorial from OpenCV on dense optical flow: https://docs.opencv.org/4.x/d4/dee/tutorial_optical_flow.html
     def estimate_velocity_optical_flow(self, img):
-        frame2 = cv2.resize(img, (320, 240), interpolation=cv2.INTER_AREA)
-        next = cv2.cvtColor(frame2, cv2.COLOR_BGR2GRAY)
+        next = self.preprocessor.process(img)
+        # previous_frame is set to None by the caller to reset the estimator, which also drops the flow used as the seed.
         if self.previous_frame is None:
             self.previous_frame = next
+            self.flow = None
             return None
 
-        flow = cv2.calcOpticalFlowFarneback(self.previous_frame, next, None, 0.5, 3, 10, 5, 5, 1.2, 0)
+        start_time = time.perf_counter()
+        self.flow = self.calc_flow(self.previous_frame, next, self.flow if self.seed_flow else None)
         self.previous_frame = next
+        flow_time = time.perf_counter()
+        self.timings["flow"] = flow_time - start_time
+        tracing.record("flow", start_time, flow_time)
+
+        # The statistics run in buffers allocated once per frame size. flow_x is a copy, so the flow is kept intact as the next seed.
+        if self._flow_buffers is None or self._flow_buffers[0].shape != next.shape:
+            self._flow_buffers = (np.empty(next.shape, np.float32), np.empty(next.shape, np.float32),
+                                  np.empty(next.size, np.float32), np.empty(next.shape, bool))
+        flow_x, key, scratch, mask = self._flow_buffers
 
         # Suppress brightest pixels which are likely to be noisy in the optical flow output.
-        threshold = 225  
-        flow_x = flow[..., 0]
-        flow_x[next > threshold] = 0
-        flow_x_data = flow_x.flatten()
+        np.copyto(flow_x, self.flow[..., 0])
+        np.greater(next, self.brightness_threshold, out=mask)
+        flow_x[mask] = 0
 
         # If the flow is mostly in one direction, take only the data in that direction to get a more accurate estimate of the velocity.
-        proportion = np.sum([flow_x_data > 0])/flow_x_data.size
+        positive = np.count_nonzero(np.greater(flow_x, 0, out=mask))
+        proportion = positive / flow_x.size
         if abs(proportion - 0.5) > 0.05:
-            if proportion > 0.5:
-                flow_x_data = flow_x_data[flow_x_data > 0]
-            else:
-                flow_x_data = flow_x_data[flow_x_data < 0]
-
-        abs_flow_x_data = np.abs(flow_x_data)
-
-        # Only take the top 20% of the flow data, as most of the vectors are close to 0
-        threshold = np.percentile(abs_flow_x_data, 80)
-        top_20_percent = flow_x_data[abs_flow_x_data >= threshold]
-        return np.mean(top_20_percent)
-    
\ No newline at end of file
+            sign = 1.0 if proportion > 0.5 else -1.0
+            candidates = positive if proportion > 0.5 else np.count_nonzero(np.less(flow_x, 0, out=mask))
+            np.multiply(flow_x, sign, out=key) # The data in the other direction is negative and never selected
+        else:
+            sign = None
+            candidates = flow_x.size
+            np.abs(flow_x, out=key)
+
+        # Only take the top 20% of the flow data, as most of the vectors are close to 0.
+        # One partial sort of a copy of the key puts the top 20% at its end.
+        count = max(int(np.ceil(0.2 * candidates)), 1)
+        np.copyto(scratch, key.ravel())
+        scratch.partition(scratch.size - count)
+        if sign is not None:
+            top_20_percent = scratch[scratch.size - count:] # The selected values, times sign
+            mean, variance = sign * top_20_percent.mean(), top_20_percent.var()
+        else:
+            np.greater_equal(key, scratch[scratch.size - count], out=mask)
+            mean, variance = flow_x.mean(where=mask), flow_x.var(where=mask)
+        # The flow is reported in pixels of a 320 pixel wide frame, the resolution the gains were tuned at.
+        velocity = float(mean) * 320 / self.W
+        # Neighbouring flow vectors share most of their 10x10 averaging window, so they are not independent samples
+        self.variance = max(float(variance) * (320 / self.W) ** 2 / max(count / 100, 1), self.min_variance)
+        self.inliers = count
+        self.timings["statistics"] = time.perf_counter() - flow_time
+        return velocity
+
+    # This method is based on the tutorial from OpenCV on Lucas-Kanade optical flow: https://docs.opencv.org/4.x/d4/dee/tutorial_optical_flow.html
+    def estimate_velocity_sparse_flow(self, img):
+        gray = self.preprocessor.process(img)
+
+        # previous_frame is set to None by the caller to reset the estimator, which also drops the tracks.
+        if self.previous_frame is None or self.previous_pts is None:
+            self.previous_frame = gray
+            self.previous_pts = self.extractor.detect(gray, self.max_tracks)
+            return None
+
+        start_time = time.perf_counter()
+        pts, status, _ = cv2.calcOpticalFlowPyrLK(self.previous_frame, gray, self.previous_pts, None, **self.lk_params)
+        track_time = time.perf_counter()
+        self.timings["track"] = track_time - start_time
+        tracing.record("track", start_time, track_time)
+
+        tracked = status.ravel() == 1
+        # Same signal as the feature matching: the displacement in x divided by the focal length.
+        control_deltas = (pts[tracked] - self.previous_pts[tracked]).reshape(-1, 2) / self.F
+        # Same distance test as the feature matching.
+        control_deltas = control_deltas[np.einsum("ij,ij->i", control_deltas, control_deltas) < self.extractor.gate_radius ** 2]
+        velocity = np.mean(control_deltas[..., 0]) if len(control_deltas) >= 10 else None
+        if velocity is not None:
+            self.variance = self._variance_of_mean(control_deltas[..., 0], len(control_deltas))
+            self.inliers = len(control_deltas)
+        self.timings["statistics"] = time.perf_counter() - track_time
+
+        # Keep tracking the surviving points, and only pay for detection again when they no longer cover the image.
+        self.previous_frame = gray
+        self.previous_pts = pts[tracked]
+        if not self._tracks_are_healthy(self.previous_pts, gray.shape):
+            self.previous_pts = self.extractor.detect(gray, self.max_tracks)
+
+        return velocity
+
+    def get_timings(self):
+        """
+        Returns: dict of the time in seconds spent in each stage of the last frame (preprocess, detect, describe, match,
+                 filter, fit, flow, track, statistics), for the stages that ran.
+        """
+        timings = dict(self.preprocessor.timings)
+        timings.update(self.extractor.timings)
+        timings.update(self.timings)
+        return timings
+
+    def reset_timings(self):
+        """
+        Clears the stage timings, so get_timings after the next frame only reports the stages that frame ran.
+        """
+        self.preprocessor.timings.clear()
+        self.extractor.timings.clear()
+        self.timings.clear()
+
+    def _variance_of_mean(self, values, samples):
+        return max(float(np.var(values)) / max(samples, 1), self.min_variance)
+
+    def _tracks_are_healthy(self, pts, shape):
+        """
+        Checks that there are enough tracked points and that they are spread over the image.
+        """
+        if len(pts) < self.min_tracks:
+            return False
+        h, w = shape[:2]
+        cells_x = np.clip((pts[:, 0, 0] * self.coverage_grid / w).astype(np.intp), 0, self.coverage_grid - 1)
+        cells_y = np.clip((pts[:, 0, 1] * self.coverage_grid / h).astype(np.intp), 0, self.coverage_grid - 1)
+        occupied = np.unique(cells_y * self.coverage_grid + cells_x).size
+        return occupied >= self.min_coverage * self.coverage_grid * self.coverage_grid
@@ -0,0 +1,137 @@
+import time
+from collections import deque
+
+import numpy as np
+
+
+class VelocityFilter:
+    """
+    A Kalman filter on the drone's velocity that sits between the VelocityEstimator and the PIDController.
+    The state is the velocity and an unknown constant acceleration (the drift caused by an off-center trim).
+    predict advances the state with the commanded output of the controller, so it can run at the packet rate while
+    vision runs slower or fails, and update fuses a velocity measurement weighted by its variance.
+
+    Measurements arrive late, after the frame has been captured and processed. update takes the capture time of the
+    measurement, rewinds to the state at that time, applies the measurement there and replays the commands issued since.
+
+    The velocity is in the units of the estimator method that feeds the filter, and the command in the units of the
+    controller output (trim = 128 - output in main.py).
+    """
+    def __init__(self, plant_gain=0.0, process_noise=1e-4, drift_noise=1e-6, initial_variance=1e-2, history_length=64,
+                 failure_variance=1e-4, max_failures=20):
+        """
+        :param plant_gain: Change in velocity per second per unit of command. 0 to only use the measurements.
+        :param process_noise: Growth of the velocity variance per second, how far the drone can deviate from the model.
+        :param drift_noise: Growth of the drift variance per second, how fast the drift can change.
+        :param initial_variance: Variance of the velocity and drift after a reset.
+        :param history_length: Number of predict steps kept for late measurements.
+        :param failure_variance: Added to the velocity variance for every failed estimate, see miss.
+        :param max_failures: Failed estimates in a row after which the filter is reset.
+        """
+        self.plant_gain = plant_gain
+        self.process_noise = process_noise
+        self.drift_noise = drift_noise
+        self.initial_variance = initial_variance
+        self.failure_variance = failure_variance
+        self.max_failures = max_failures
+        self.history = deque(maxlen=history_length)
+        self.reset()
+
+    def reset(self):
+        self.x = np.zeros(2) # velocity, drift
+        self.P = np.diag([self.initial_variance, self.initial_variance])
+        self.t = None
+        self.command = 0.0
+        self.failures = 0 # Failed estimates since the last measurement
+        # (time, command applied from that time, state, covariance) after each predict
+        self.history.clear()
+
+    @property
+    def velocity(self):
+        return self.x[0]
+
+    @property
+    def variance(self):
+        return self.P[0, 0]
+
+    def predict(self, now=None, command=None):
+        """
+        Advances the state to now (time.monotonic() by default) with the command held since the last predict, then
+        switches to the new command if one is given.
+
+        Returns: the predicted velocity.
+        """
+        now = time.monotonic() if now is None else now
+        if self.t is not None and now > self.t:
+            self.x, self.P = self._propagate(self.x, self.P, self.command, now - self.t)
+        self.t = now
+        if command is not None:
+            self.command = command
+        self.history.append((now, self.command, self.x.copy(), self.P.copy()))
+        return self.x[0]
+
+    def update(self, measurement, variance, timestamp=None):
+        """
+        Fuses a velocity measurement with the given variance, measured at timestamp (time.monotonic(), e.g. the capture
+        time of the frame). Without a timestamp, or one older than the history, the measurement is applied at the
+        current time.
+        """
+        self.failures = 0
+        if self.t is None:
+            self.predict(timestamp)
+
+        start = None
+        if timestamp is not None and timestamp < self.t:
+            # The last predict step before the measurement
+            for i in range(len(self.history) - 1, -1, -1):
+                if self.history[i][0] <= timestamp:
+                    start = i
+                    break
+        if start is None:
+            self.x, self.P = self._correct(self.x, self.P, measurement, variance)
+            if self.history:
+                t, command, _, _ = self.history[-1]
+                self.history[-1] = (t, command, self.x.copy(), self.P.copy())
+            return
+
+        # Rewind to the measurement, correct, and replay the commands issued since
+        t, command, x, P = self.history[start]
+        x, P = self._propagate(x, P, command, timestamp - t)
+        x, P = self._correct(x, P, measurement, variance)
+        t = timestamp
+        for i in range(start + 1, len(self.history)):
+            step_time, step_command, _, _ = self.history[i]
+            x, P = self._propagate(x, P, command, step_time - t)
+            self.history[i] = (step_time, step_command, x.copy(), P.copy())
+            t, command = step_time, step_command
+        self.x, self.P = x, P
+
+    def miss(self):
+        """
+        Records a failed estimate. The prediction has gone without a correction, so the velocity and drift variances
+        grow and the next measurement is trusted more. After max_failures in a row the filter is reset, so a long
+        outage does not leave a confident but stale state.
+        """
+        self.failures += 1
+        if self.failures >= self.max_failures:
+            self.reset()
+            return
+        self.P = self.P + np.diag([self.failure_variance, self.failure_variance * self.drift_noise / self.process_noise])
+        if self.history:
+            t, command, _, _ = self.history[-1]
+            self.history[-1] = (t, command, self.x.copy(), self.P.copy())
+
+    def _propagate(self, x, P, command, dt):
+        F = np.array([[1.0, dt], [0.0, 1.0]])
+        x = F @ x
+        x[0] += self.plant_gain * command * dt
+        P = F @ P @ F.T + np.diag([self.process_noise * dt, self.drift_noise * dt])
+        return x, P
+
+    def _correct(self, x, P, measurement, variance):
+        # Only the velocity is measured
+        S = P[0, 0] + variance
+        K = P[:, 0] / S
+        x = x + K * (measurement - x[0])
+        P = P - np.outer(K, P[0, :])
+        return x, P
@@ -0,0 +1,173 @@
+import multiprocessing
+import queue
+import time
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from VelocityEstimator import VelocityEstimator
+
+
+def _worker_loop(slot_names, frame_shape, frame_dtype, estimator_kwargs, jobs, results):
+    """
+    Runs in the worker process. Estimates the velocity of every frame it is handed and reports it back.
+    """
+    slots = [shared_memory.SharedMemory(name=name) for name in slot_names]
+    frames = [np.ndarray(frame_shape, dtype=frame_dtype, buffer=slot.buf) for slot in slots]
+    velocity_estimator = VelocityEstimator(**estimator_kwargs)
+    # The estimator may keep a reference to the previous frame, so that slot is only released after the next frame.
+    held_slot = None
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        if job == "reset":
+            velocity_estimator.previous_frame = None
+            continue
+
+        slot, seq, capture_time = job
+        try:
+            velocity = velocity_estimator.estimate_velocity(frames[slot])
+        except Exception:
+            # Report one bad frame as a failed estimate instead of ending the worker, and start over from the next frame
+            traceback.print_exc()
+            velocity_estimator.previous_frame = None
+            velocity_estimator.variance = velocity_estimator.motion = velocity_estimator.motion_variance = None
+            velocity_estimator.inliers = 0
+            velocity = None
+        results.put((seq, velocity, velocity_estimator.variance, velocity_estimator.inliers, velocity_estimator.motion,
+                     velocity_estimator.motion_variance, capture_time, time.monotonic(), held_slot))
+        held_slot = slot
+
+    del frames
+    for slot in slots:
+        slot.close()
+
+
+class VisionWorker:
+    """
+    Runs a VelocityEstimator in a separate process, so its NumPy and Python heavy parts do not hold the GIL of the
+    process running the keyboard poller, the frame source and the packet sender.
+
+    Frames are copied into shared memory slots (multiprocessing.shared_memory) and only the slot number, sequence number
+    and capture time are sent to the worker, so frames are never pickled. Results come back with the capture time of the
+    frame and the time the estimate was completed, both from time.monotonic().
+
+    submit and poll never block: if every slot is busy the frame is dropped, and poll returns None until a result arrives.
+    """
+    def __init__(self, frame_shape=None, frame_dtype=np.uint8, num_slots=3, **estimator_kwargs):
+        """
+        :param frame_shape: Shape of the frames that will be submitted. By default the slots are sized from the first
+                            frame submitted, and the worker process is started then, so any source (FFmpegCapture,
+                            grayscale or resized frames) works without configuring it.
+        :param num_slots: Number of shared memory slots. At least 3: one being written, one being processed, and one
+                          holding the estimator's previous frame.
+        :param estimator_kwargs: Arguments for the VelocityEstimator created in the worker process, e.g. method="sparse_flow".
+        """
+        self.num_slots = max(3, num_slots)
+        self.estimator_kwargs = estimator_kwargs
+        self.frame_shape = None
+        self.frame_dtype = None
+        self._slots = []
+        self._frames = []
+        self._free_slots = []
+        self._jobs = multiprocessing.Queue()
+        self._results = multiprocessing.Queue()
+        self._process = None
+        self._latest_result = None
+        self.frames_dropped = 0
+        if frame_shape is not None:
+            self._start(tuple(frame_shape), np.dtype(frame_dtype))
+
+    def _start(self, frame_shape, frame_dtype):
+        self.frame_shape = frame_shape
+        self.frame_dtype = frame_dtype
+        size = int(np.prod(frame_shape)) * frame_dtype.itemsize
+        self._slots = [shared_memory.SharedMemory(create=True, size=size) for _ in range(self.num_slots)]
+        self._frames = [np.ndarray(frame_shape, dtype=frame_dtype, buffer=slot.buf) for slot in self._slots]
+        self._free_slots = list(range(len(self._slots)))
+        self._process = multiprocessing.Process(target=_worker_loop,
+                                                args=([slot.name for slot in self._slots], frame_shape, frame_dtype.str,
+                                                      self.estimator_kwargs, self._jobs, self._results),
+                                                daemon=True)
+        self._process.start()
+
+    def submit(self, frame, seq, capture_time):
+        """
+        Copies the frame into a free slot and hands it to the worker. The first frame sizes the slots unless frame_shape
+        was given, and every frame after it must have the same shape and dtype.
+
+        Returns: True if the frame was submitted, False if it was dropped because the worker is still busy.
+        Raises RuntimeError if the worker process has exited.
+        """
+        if self._process is None:
+            self._start(frame.shape, frame.dtype)
+        else:
+            self._check_alive()
+        if frame.shape != self.frame_shape or frame.dtype != self.frame_dtype:
+            raise ValueError(f"VisionWorker slots hold {self.frame_dtype} frames of shape {self.frame_shape}, "
+                             f"got {frame.dtype} of shape {frame.shape}")
+        self._collect_results()
+        if not self._free_slots:
+            self.frames_dropped += 1
+            return False
+        slot = self._free_slots.pop()
+        np.copyto(self._frames[slot], frame)
+        self._jobs.put((slot, seq, capture_time))
+        return True
+
+    def poll(self):
+        """
+        Returns: the newest result since the last poll as a dict with seq, velocity (None if the estimate failed),
+                 variance, inliers, motion and motion_variance (see VelocityEstimator.estimate_motion), capture_time
+                 and done_time, or None if there is no new result.
+        Raises RuntimeError if the worker process has exited.
+        """
+        self._collect_results()
+        if self._latest_result is None:
+            self._check_alive()
+        result, self._latest_result = self._latest_result, None
+        return result
+
+    def reset(self):
+        """
+        Resets the worker's estimator, like setting previous_frame to None on a local VelocityEstimator.
+        """
+        self._jobs.put("reset")
+
+    def _check_alive(self):
+        if self._process is not None and not self._process.is_alive():
+            raise RuntimeError(f"VisionWorker process exited with code {self._process.exitcode}")
+
+    def _collect_results(self):
+        while True:
+            try:
+                (seq, velocity, variance, inliers, motion, motion_variance,
+                 capture_time, done_time, released_slot) = self._results.get_nowait()
+            except queue.Empty:
+                break
+            if released_slot is not None:
+                self._free_slots.append(released_slot)
+            self._latest_result = {"seq": seq, "velocity": velocity, "variance": variance, "inliers": inliers, "motion": motion,
+                                   "motion_variance": motion_variance, "capture_time": capture_time, "done_time": done_time}
+
+    def close(self):
+        """
+        Stops the worker process and frees the shared memory slots. Safe to call more than once.
+        """
+        if self._process is None:
+            return
+        if self._process.is_alive():
+            self._jobs.put(None)
+            self._process.join(timeout=1.0)
+        if self._process.is_alive():
+            self._process.terminate()
+        self._process = None
+        self._frames = [] # The views must go before their slots can be closed
+        for slot in self._slots:
+            slot.close()
+            slot.unlink()
+        self._slots = []
+        self._free_slots = []
@@ -0,0 +1,163 @@
+import argparse
+import json
+import time
+
+import cv2
+import numpy as np
+
+from benchmark_CV import summarize
+from extractor import FeatureExtractor
+from FrameSource import GroundTruthCapture
+from VelocityEstimator import VelocityEstimator
+
+# Accuracy against cost of the velocity estimation configurations, on synthetic clips with known motion.
+# The recordings have no ground truth, so every clip here is made by GroundTruthCapture: a texture (random, or an image
+# such as a frame of a recording) moved by a known sub-pixel translation, yaw and scale change, with noise, blur and
+# brightness flicker on top. Each configuration estimates the velocity of every clip, and its error against the true
+# x motion is reported next to its latency. The cheapest configuration that meets the accuracy target is picked.
+#
+# Example:
+#   python accuracy_CV.py --target 0.25 --output accuracy.json
+#   python accuracy_CV.py --texture README_imgs/snapshot.png --scenarios pan noisy --configs feature_matching sparse_flow
+
+# Motion and image degradation of each clip. Translations are in pixels of the drone's 640x480 frames per frame read.
+SCENARIOS = {
+    "slow_pan": dict(translation=(0.6, 0.0), jitter=0.2),
+    "pan": dict(translation=(3.0, 0.5), jitter=0.5),
+    "fast_pan": dict(translation=(9.0, -1.0), jitter=1.0),
+    "yaw": dict(translation=(2.0, 0.0), rotation=0.5, jitter=0.5),
+    "altitude": dict(translation=(2.0, 0.0), scale=1.005, jitter=0.5),
+    "noisy": dict(translation=(3.0, 0.0), jitter=0.5, noise=8.0, blur=1.0, flicker=0.15),
+}
+
+# Estimator configurations: (method, VelocityEstimator arguments, FeatureExtractor arguments).
+CONFIGURATIONS = {
+    "feature_matching": ("feature_matching", {}, {}),
+    "feature_matching/grid_matcher": ("feature_matching", {}, dict(matcher="grid")),
+    "feature_matching/grid_detection": ("feature_matching", {}, dict(detection="grid")),
+    "feature_matching/affine": ("feature_matching", {}, dict(fit_backend="affine")),
+    "feature_matching/translation": ("feature_matching", {}, dict(fit_backend="translation")),
+    "feature_matching/160x120": ("feature_matching", dict(resolution=(160, 120)), {}),
+    "optical_flow": ("optical_flow", {}, {}),
+    "optical_flow/160x120": ("optical_flow", dict(resolution=(160, 120)), {}),
+    "optical_flow/farneback_coarse": ("optical_flow", dict(flow_backend="farneback_coarse"), {}),
+    "optical_flow/farneback_coarse/seeded": ("optical_flow", dict(flow_backend="farneback_coarse", seed_flow=True), {}),
+    "optical_flow/dis": ("optical_flow", dict(flow_backend="dis"), {}),
+    "optical_flow/dis/640x480": ("optical_flow", dict(flow_backend="dis", resolution=(640, 480)), {}),
+    "sparse_flow": ("sparse_flow", {}, {}),
+    "sparse_flow/160x120": ("sparse_flow", dict(resolution=(160, 120)), {}),
+}
+
+NATIVE_WIDTH = 640
+FOCAL_LENGTH = 450 # Focal length of the 640x480 frames, see VelocityEstimator
+
+
+def to_native_pixels(method, velocity):
+    """
+    Converts a velocity estimate to pixels of the 640x480 frames. Feature matching and sparse flow report the
+    displacement divided by the focal length, and optical flow reports pixels of a 320 pixel wide frame.
+    """
+    if method == "optical_flow":
+        return velocity * NATIVE_WIDTH / 320
+    return velocity * FOCAL_LENGTH
+
+
+def make_clip(scenario, num_frames, texture=None, seed=0):
+    """
+    Returns: (frames, true x motion of each frame in pixels)
+    """
+    cap = GroundTruthCapture(texture=texture, seed=seed, **SCENARIOS[scenario])
+    frames, truth = [], []
+    for _ in range(num_frames):
+        _, frame = cap.read()
+        frames.append(frame)
+        truth.append(cap.motion["dx"])
+    return frames, np.array(truth)
+
+
+def create_estimator(config):
+    method, estimator_kwargs, extractor_kwargs = CONFIGURATIONS[config]
+    return VelocityEstimator(method=method, extractor=FeatureExtractor(**extractor_kwargs), **estimator_kwargs)
+
+
+def evaluate(config, frames, truth):
+    method = CONFIGURATIONS[config][0]
+    velocity_estimator = create_estimator(config)
+    errors, latencies = [], []
+    attempts = 0
+    for frame, dx in zip(frames, truth):
+        had_previous = velocity_estimator.previous_frame is not None
+        start_time = time.perf_counter()
+        velocity = velocity_estimator.estimate_velocity(frame)
+        latencies.append(time.perf_counter() - start_time)
+        if had_previous:
+            attempts += 1
+            if velocity is not None:
+                errors.append(to_native_pixels(method, velocity) - dx)
+
+    errors = np.abs(np.array(errors))
+    return {
+        "mae_px": float(errors.mean()) if len(errors) else float("inf"),
+        "p95_error_px": float(np.percentile(errors, 95)) if len(errors) else float("inf"),
+        "failure_rate": 1.0 - len(errors) / attempts if attempts else 1.0,
+        "latency_ms": summarize(latencies),
+    }
+
+
+def pick_cheapest(results, target, max_failure_rate):
+    """
+    Returns: the configuration with the lowest mean p50 latency whose mean absolute error is at most target pixels and
+             whose failure rate is at most max_failure_rate in every scenario, or None if no configuration qualifies.
+    """
+    best, best_cost = None, float("inf")
+    for config, scenarios in results.items():
+        if any(r["mae_px"] > target or r["failure_rate"] > max_failure_rate for r in scenarios.values()):
+            continue
+        cost = np.mean([r["latency_ms"]["p50"] for r in scenarios.values()])
+        if cost < best_cost:
+            best, best_cost = config, cost
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Accuracy against cost of the velocity estimation configurations on synthetic clips with known motion.")
+    parser.add_argument("--configs", nargs="+", default=list(CONFIGURATIONS), choices=list(CONFIGURATIONS))
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument("--texture", help="Image used as the scene, e.g. a frame of a recording. A random texture by default.")
+    parser.add_argument("--frames", type=int, default=60, help="Frames per clip")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--target", type=float, default=0.25, help="Largest allowed mean absolute error, in pixels of a 640 pixel wide frame")
+    parser.add_argument("--max-failure-rate", type=float, default=0.05, help="Largest allowed fraction of failed estimates")
+    parser.add_argument("--output", default="accuracy.json")
+    args = parser.parse_args()
+
+    texture = None
+    if args.texture:
+        texture = cv2.imread(args.texture)
+        if texture is None:
+            parser.error(f"Could not read {args.texture}")
+
+    clips = {scenario: make_clip(scenario, args.frames, texture, args.seed) for scenario in args.scenarios}
+    results = {}
+    for config in args.configs:
+        results[config] = {}
+        for scenario, (frames, truth) in clips.items():
+            result = evaluate(config, frames, truth)
+            results[config][scenario] = result
+            print(f"{config} on {scenario}: error {result['mae_px']:.3f} px (p95 {result['p95_error_px']:.3f} px), "
+                  f"{result['failure_rate']:.0%} failed, p50 {result['latency_ms']['p50']:.2f} ms")
+
+    best = pick_cheapest(results, args.target, args.max_failure_rate)
+    if best is None:
+        print(f"No configuration reaches {args.target} px in every scenario.")
+    else:
+        print(f"Cheapest configuration within {args.target} px: {best}")
+
+    output = {"opencv": cv2.__version__, "numpy": np.__version__, "arguments": vars(args), "best": best, "results": results}
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+    print(f"Saved results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
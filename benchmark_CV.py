@@ -0,0 +1,160 @@
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from FrameSource import SyntheticCapture
+from VelocityEstimator import VelocityEstimator
+
+# Headless benchmark for the velocity estimation methods, the counterpart of test_CV.py without a window or plots.
+# Each method is run over recorded videos and synthetic clips, and the time spent in every stage is reported as
+# p50/p95/p99 latency in milliseconds, along with throughput and peak memory. Results are written as JSON, and can be
+# compared against a saved baseline to flag regressions.
+#
+# Example:
+#   python benchmark_CV.py --videos output_light.mp4 --synthetic 2 --output baseline.json
+#   (change extractor.py)
+#   python benchmark_CV.py --videos output_light.mp4 --synthetic 2 --output new.json --compare baseline.json
+
+METHODS = ["feature_matching", "optical_flow", "sparse_flow"]
+STAGES = ["preprocess", "detect", "describe", "match", "filter", "fit", "flow", "track", "statistics"]
+# Stages faster than this are not flagged as regressions, their timings are mostly noise.
+MIN_COMPARED_MS = 0.1
+
+
+def load_frames(cap, stride=3, max_frames=300):
+    """
+    Reads every stride-th frame, as test_CV.py does, so decoding is not part of the measured time.
+    """
+    frames = []
+    while len(frames) < max_frames:
+        for _ in range(stride - 1):
+            cap.read()
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    return frames
+
+
+def synthetic_clips(count, num_frames):
+    velocities = [(2.0, 0.0), (-3.0, 1.0), (0.5, 0.0), (6.0, -2.0)]
+    clips = {}
+    for i in range(count):
+        velocity = velocities[i % len(velocities)]
+        clips[f"synthetic_{i}"] = load_frames(SyntheticCapture(velocity=velocity, seed=i), stride=1, max_frames=num_frames)
+    return clips
+
+
+def summarize(values):
+    values = np.asarray(values) * 1000
+    if len(values) == 0:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "mean": 0.0, "count": 0}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99), "mean": float(values.mean()), "count": len(values)}
+
+
+def benchmark(method, frames):
+    velocity_estimator = VelocityEstimator(method=method)
+    stage_times = {stage: [] for stage in STAGES}
+    totals = []
+    valid = 0
+    for frame in frames:
+        velocity_estimator.reset_timings()
+        start_time = time.perf_counter()
+        velocity = velocity_estimator.estimate_velocity(frame)
+        totals.append(time.perf_counter() - start_time)
+        for stage, duration in velocity_estimator.get_timings().items():
+            stage_times.setdefault(stage, []).append(duration)
+        if velocity is not None:
+            valid += 1
+
+    # Memory is measured in a second pass, tracemalloc slows down the code it traces.
+    # NumPy allocations are traced, OpenCV's internal buffers are not.
+    velocity_estimator = VelocityEstimator(method=method)
+    tracemalloc.start()
+    for frame in frames:
+        velocity_estimator.estimate_velocity(frame)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        "frames": len(frames),
+        "valid_estimates": valid,
+        "total_ms": summarize(totals),
+        "stages_ms": {stage: summarize(times) for stage, times in stage_times.items() if times},
+        "throughput_fps": len(frames) / sum(totals) if totals else 0.0,
+        "peak_traced_memory_mb": peak_memory / 1e6,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns: list of regressions, results whose p50 or p95 is more than tolerance (a fraction) slower than the baseline.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        timings = [("total", result["total_ms"], old["total_ms"])]
+        timings += [(stage, result["stages_ms"][stage], old["stages_ms"][stage])
+                    for stage in result["stages_ms"] if stage in old["stages_ms"]]
+        for stage, new_ms, old_ms in timings:
+            for key in ("p50", "p95"):
+                if old_ms[key] >= MIN_COMPARED_MS and new_ms[key] > old_ms[key] * (1 + tolerance):
+                    regressions.append(f"{name} {stage} {key}: {old_ms[key]:.2f} ms -> {new_ms[key]:.2f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless per-stage benchmark of the velocity estimation methods.")
+    parser.add_argument("--methods", nargs="+", default=METHODS, choices=METHODS)
+    parser.add_argument("--videos", nargs="*", default=[], help="Recorded videos, e.g. output_light.mp4")
+    parser.add_argument("--synthetic", type=int, default=2, help="Number of synthetic clips")
+    parser.add_argument("--stride", type=int, default=3, help="Use every stride-th frame of the videos")
+    parser.add_argument("--max-frames", type=int, default=300, help="Frames per clip")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--compare", help="Baseline JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed slowdown against the baseline, as a fraction")
+    args = parser.parse_args()
+
+    clips = synthetic_clips(args.synthetic, args.max_frames)
+    for video in args.videos:
+        clips[video] = load_frames(cv2.VideoCapture(video), args.stride, args.max_frames)
+
+    results = {}
+    for clip_name, frames in clips.items():
+        if not frames:
+            print(f"No frames in {clip_name}, skipping.")
+            continue
+        for method in args.methods:
+            name = f"{clip_name}::{method}"
+            results[name] = benchmark(method, frames)
+            total = results[name]["total_ms"]
+            print(f"{name}: p50 {total['p50']:.2f} ms, p95 {total['p95']:.2f} ms, p99 {total['p99']:.2f} ms, "
+                  f"{results[name]['throughput_fps']:.1f} fps")
+
+    output = {"opencv": cv2.__version__, "numpy": np.__version__, "results": results}
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+    print(f"Saved results to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        if regressions:
+            sys.exit(1)
+        print("No regressions.")
+
+
+if __name__ == "__main__":
+    main()
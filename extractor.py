@@ -1,9 +1,12 @@
 # This code is from LearnOpenCV's monocular SLAM tutorial, with some modifications to fit the drone control context.
 
+import time
+
 import cv2
 import numpy as np
-from skimage.measure import ransac
-from skimage.transform import FundamentalMatrixTransform
+
+import tracing
+from model_fitting import FIT_BACKENDS
 
 
 def add_ones(x):
@@ -15,23 +18,386 @@ def add_ones(x):
 
 IRt = np.eye(4)
 
-def extract(img):
-    orb = cv2.ORB_create()
-    
-    # Convert to grayscale
-    gray_img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+# Number of set bits in every byte value, used to compute Hamming distances between ORB descriptors with NumPy.
+POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.int32)
+
+
+def hamming_distance(des1, des2):
+    """
+    Row-wise Hamming distance between two equally shaped arrays of 32 byte ORB descriptors.
+    """
+    xor = des1 ^ des2
+    if hasattr(np, "bitwise_count"):
+        # NumPy 2.0+ counts bits natively, four 64 bit words per descriptor.
+        return np.bitwise_count(xor.view(np.uint64)).sum(axis=1, dtype=np.int32)
+    return POPCOUNT[xor].sum(axis=1)
+
+
+class PointGrid(object):
+    """
+    Buckets points into square cells so the points near a location can be found without scanning all of them.
+    The point indices are stored sorted by cell, and cell_start[c]:cell_start[c + 1] is the slice belonging to cell c.
+    """
+    def __init__(self, pts, cell_size):
+        self.cell_size = cell_size
+        self.origin = pts.min(axis=0) if len(pts) > 0 else np.zeros(2)
+        cells = np.floor((pts - self.origin) / cell_size).astype(np.intp)
+        self.grid_w = int(cells[:, 0].max()) + 1 if len(pts) > 0 else 1
+        self.grid_h = int(cells[:, 1].max()) + 1 if len(pts) > 0 else 1
+
+        cell_ids = cells[:, 1] * self.grid_w + cells[:, 0]
+        self.order = np.argsort(cell_ids, kind="stable")
+        self.cell_start = np.searchsorted(cell_ids[self.order], np.arange(self.grid_w * self.grid_h + 1))
+
+    def candidates(self, pts):
+        """
+        Finds every grid point in the 3x3 block of cells around each of pts.
+        With cell_size equal to the search radius this covers every grid point within that radius.
+
+        Returns: (query, train) arrays of candidate pairs, indices into pts and into the gridded points.
+        """
+        cells = np.floor((pts - self.origin) / self.cell_size).astype(np.intp)
+        queries, starts, counts = [], [], []
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                cx = cells[:, 0] + dx
+                cy = cells[:, 1] + dy
+                valid = np.flatnonzero((cx >= 0) & (cx < self.grid_w) & (cy >= 0) & (cy < self.grid_h))
+                cell_ids = cy[valid] * self.grid_w + cx[valid]
+                queries.append(valid)
+                starts.append(self.cell_start[cell_ids])
+                counts.append(self.cell_start[cell_ids + 1] - self.cell_start[cell_ids])
+        queries = np.concatenate(queries)
+        starts = np.concatenate(starts)
+        counts = np.concatenate(counts)
+
+        # Expand each (query, cell) into one pair per point in that cell.
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return np.repeat(queries, counts), self.order[np.repeat(starts, counts) + offsets]
+
+
+class FeatureExtractor(object):
+    """
+    Holds the detector, descriptor and matcher used for feature matching so they are created once
+    instead of on every frame. An instance is owned by VelocityEstimator and shared by every Frame it builds.
+    The time spent in each stage of the last call is stored in self.timings (seconds, from time.perf_counter).
+    """
+    def __init__(self, max_corners=8000, quality_level=0.01, min_distance=10, keypoint_size=20, vectorized=True,
+                 matcher="brute_force", gate_radius=0.1, fallback_gate_radius=0.3, min_grid_match_ratio=0.1, max_hamming=50,
+                 fit_backend="usac_fundamental", residual_threshold=0.005, max_trials=200, confidence=0.99,
+                 detection="global", grid_shape=(8, 6), target_latency=None, min_features=200):
+        self.max_corners = max_corners
+        self.quality_level = quality_level
+        self.min_distance = min_distance
+        self.keypoint_size = keypoint_size
+        # "global" detects the strongest corners over the whole image, which clusters them on the most textured area.
+        # "grid" splits the image into grid_shape (columns, rows) cells and detects up to feature_budget / cells in each.
+        if detection not in ("global", "grid"):
+            raise ValueError("Unknown detection mode")
+        self.detection = detection
+        self.grid_shape = grid_shape
+        # Number of corners detected per frame. With target_latency set (seconds), it is adjusted after every match
+        # so that the measured extract + match time approaches the target, between min_features and max_corners.
+        self.feature_budget = max_corners
+        self.target_latency = target_latency
+        self.min_features = min_features
+        # Apply the ratio and displacement tests as array masks instead of looping over every match in Python.
+        self.vectorized = vectorized
+        # "brute_force" compares every descriptor of the previous frame against every descriptor of the current one.
+        # "grid" only compares keypoints that are within gate_radius of each other, using a PointGrid of the previous frame.
+        # If the grid matches less than min_grid_match_ratio of the previous frame's keypoints (the drone moved further
+        # than gate_radius) it falls back to an LSH index over all descriptors, gated at fallback_gate_radius instead.
+        if matcher not in ("brute_force", "grid"):
+            raise ValueError("Unknown matcher")
+        self.matcher_type = matcher
+        # Maximum displacement between matched points, in normalized image coordinates.
+        self.gate_radius = gate_radius
+        self.fallback_gate_radius = fallback_gate_radius
+        self.min_grid_match_ratio = min_grid_match_ratio
+        self.max_hamming = max_hamming
+
+        self.orb = cv2.ORB_create()
+        self.matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+        if self.matcher_type == "grid":
+            # FLANN_INDEX_LSH = 6
+            self.fallback_matcher = cv2.FlannBasedMatcher(dict(algorithm=6, table_number=6, key_size=12, multi_probe_level=1), dict(checks=50))
+        self.used_fallback = False
+
+        # Robust fit used to reject outlier matches, one of model_fitting.FIT_BACKENDS.
+        # The matches are passed in order of descriptor distance so the backends can sample the best matches first.
+        if fit_backend not in FIT_BACKENDS:
+            raise ValueError("Unknown fit backend")
+        self.fit_backend = fit_backend
+        self.fit_model = FIT_BACKENDS[fit_backend]
+        self.residual_threshold = residual_threshold
+        self.max_trials = max_trials
+        self.confidence = confidence
+        # The model and inlier ratio of the last fit.
+        self.model = None
+        self.inlier_ratio = 0.0
+
+        self.timings = {}
+
+    def detect(self, gray_img, max_corners=None):
+        """
+        Detects corners in a grayscale image with goodFeaturesToTrack.
+
+        :param gray_img: Grayscale image.
+        :param max_corners: Overrides self.max_corners if given.
+        Returns: N x 1 x 2 float32 array of corners, or None if no corners are found.
+        """
+        start_time = time.perf_counter()
+        max_corners = max_corners or self.feature_budget
+        if self.detection == "grid":
+            pts = self._detect_grid(gray_img, max_corners)
+        else:
+            pts = cv2.goodFeaturesToTrack(gray_img, max_corners, qualityLevel=self.quality_level, minDistance=self.min_distance)
+        end_time = time.perf_counter()
+        self.timings["detect"] = end_time - start_time
+        tracing.record("detect", start_time, end_time)
+        return pts
+
+    def _detect_grid(self, gray_img, max_corners):
+        """
+        Detects up to max_corners / cells corners in every grid cell so the corners are spread over the image.
+        The quality level is relative to the strongest corner of each cell, so weakly textured cells still get corners.
+        """
+        h, w = gray_img.shape[:2]
+        cols, rows = self.grid_shape
+        cell_cap = max(1, max_corners // (cols * rows))
+        pts = []
+        for row in range(rows):
+            y0, y1 = row * h // rows, (row + 1) * h // rows
+            for col in range(cols):
+                x0, x1 = col * w // cols, (col + 1) * w // cols
+                cell_pts = cv2.goodFeaturesToTrack(gray_img[y0:y1, x0:x1], cell_cap, qualityLevel=self.quality_level, minDistance=self.min_distance)
+                if cell_pts is not None:
+                    cell_pts += (x0, y0)
+                    pts.append(cell_pts)
+        if not pts:
+            return None
+        return np.concatenate(pts)
+
+    def _update_feature_budget(self):
+        """
+        Scales the feature budget by how far the last extract + match time was from target_latency.
+        The step is limited to 25% per frame so a single slow frame does not halve the features.
+        """
+        if self.target_latency is None:
+            return
+        latency = sum(self.timings.get(stage, 0.0) for stage in ("detect", "describe", "match", "filter", "fit"))
+        if latency <= 0:
+            return
+        scale = min(1.25, max(0.8, self.target_latency / latency))
+        self.feature_budget = int(min(self.max_corners, max(self.min_features, self.feature_budget * scale)))
+
+    def extract(self, img):
+        """
+        Detects corners in img and computes their ORB descriptors.
+
+        :param img: BGR or grayscale image.
+        Returns: (N x 2 float32 array of pixel coordinates, N x 32 descriptor array), or (empty array, None) if no corners are found.
+        """
+        # Convert to grayscale
+        if img.ndim == 3:
+            gray_img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        else:
+            gray_img = img
+
+        # Detection
+        pts = self.detect(gray_img)
+        detect_time = time.perf_counter()
+
+        if pts is None:
+            self.timings["describe"] = 0.0
+            return np.empty((0, 2), dtype=np.float32), None
+
+        # Extraction
+        # KeyPoint.convert builds the keypoints (and reads them back) in C++ rather than one Python object at a time.
+        kps = cv2.KeyPoint.convert(pts.reshape(-1, 2), size=self.keypoint_size)
+        kps, des = self.orb.compute(gray_img, kps)
+        pts = cv2.KeyPoint.convert(kps) if len(kps) > 0 else np.empty((0, 2), dtype=np.float32)
+        end_time = time.perf_counter()
+        self.timings["describe"] = end_time - detect_time
+        tracing.record("describe", detect_time, end_time)
+
+        return pts, des
 
-    # Detection
-    pts = cv2.goodFeaturesToTrack(gray_img, 8000, qualityLevel=0.01, minDistance=10)
+    def match(self, f1, f2):
+        """
+        Matches the descriptors of two Frames and filters the matches.
 
-    if pts is None:
-        return np.array([]), None
+        :param f1: The previous Frame.
+        :param f2: The current Frame.
+        Returns: (idx1, idx2) arrays of matched indices into f1.pts and f2.pts, or (None, None) if there are not enough matches.
+        """
+        if f1.des is None or f2.des is None or len(f1.des) < 2 or len(f2.des) < 2:
+            return None, None
 
-    # Extraction
-    kps = [cv2.KeyPoint(f[0][0], f[0][1], 20) for f in pts]
-    kps, des = orb.compute(gray_img, kps)
+        start_time = time.perf_counter()
 
-    return np.array([(kp.pt[0], kp.pt[1]) for kp in kps]), des
+        if self.matcher_type == "grid":
+            idx1, idx2, distances = self._filter_matches_grid(f1, f2)
+        elif self.vectorized:
+            idx1, idx2, distances = self._filter_matches_vectorized(f1, f2)
+        else:
+            idx1, idx2, distances = self._filter_matches_loop(f1, f2)
+        filter_time = time.perf_counter()
+        tracing.record("match", start_time, filter_time)
+
+        if len(idx1) < 10:
+            # print("Not enough matches")
+            self.timings["fit"] = 0.0
+            self.model = None
+            self.inlier_ratio = 0.0
+            self._update_feature_budget()
+            return None, None
+
+        # Best matches first
+        order = np.argsort(distances, kind="stable")
+        idx1, idx2 = idx1[order], idx2[order]
+
+        # Fit model
+        self.model, inliers = self.fit_model(f1.pts[idx1], f2.pts[idx2], self.residual_threshold, self.max_trials, self.confidence)
+        fit_time = time.perf_counter()
+        self.timings["fit"] = fit_time - filter_time
+        tracing.record("fit", filter_time, fit_time)
+        self.inlier_ratio = np.count_nonzero(inliers) / len(inliers)
+        self._update_feature_budget()
+        
+        # Ignore outliers
+        return idx1[inliers], idx2[inliers]
+
+    def _filter_matches_loop(self, f1, f2):
+        """
+        The original per-match filter. Kept for comparison against _filter_matches_vectorized.
+        """
+        start_time = time.perf_counter()
+        matches = self.matcher.knnMatch(f1.des, f2.des, k=2)
+        match_time = time.perf_counter()
+        self.timings["match"] = match_time - start_time
+
+        # Lowe's ratio test
+        idx1, idx2, distances = [], [], []
+        for m, n in matches:
+            if m.distance < 1.0*n.distance:
+                p1 = f1.pts[m.queryIdx]
+                p2 = f2.pts[m.trainIdx]
+                
+                # Distance test
+                # Additional distance test, ensuring that the 
+                # Euclidean distance between p1 and p2 is less than gate_radius (0.1 by default)
+                if np.linalg.norm((p1-p2)) < self.gate_radius:
+                    # Keep idxs
+                    idx1.append(m.queryIdx)
+                    idx2.append(m.trainIdx)
+                    distances.append(m.distance)
+        self.timings["filter"] = time.perf_counter() - match_time
+
+        return np.array(idx1, dtype=np.intp), np.array(idx2, dtype=np.intp), np.array(distances, dtype=np.float32)
+
+    def _filter_matches_vectorized(self, f1, f2):
+        """
+        Same filter as _filter_matches_loop, applied as whole-array masks.
+        cv2.batchDistance is what BFMatcher.knnMatch uses internally, so it returns the same two nearest neighbours
+        as plain index/distance arrays instead of a list of DMatch objects.
+        """
+        start_time = time.perf_counter()
+        distances, train_idx = cv2.batchDistance(f1.des, f2.des, cv2.CV_32S, normType=cv2.NORM_HAMMING, K=2)
+        match_time = time.perf_counter()
+        self.timings["match"] = match_time - start_time
+
+        # Lowe's ratio test
+        keep = distances[:, 0] < 1.0*distances[:, 1]
+        idx1 = np.flatnonzero(keep)
+        idx2 = train_idx[keep, 0].astype(np.intp)
+        distances = distances[keep, 0]
+
+        # Distance test, the normalized displacement between p1 and p2 must be less than gate_radius
+        deltas = f1.pts[idx1] - f2.pts[idx2]
+        keep = np.sqrt(np.einsum("ij,ij->i", deltas, deltas)) < self.gate_radius
+        self.timings["filter"] = time.perf_counter() - match_time
+
+        return idx1[keep], idx2[keep], distances[keep]
+
+    def _filter_matches_grid(self, f1, f2):
+        """
+        Matches each keypoint of the current frame against only the keypoints of the previous frame within gate_radius,
+        so the cost grows with the number of features rather than its square.
+        The ratio test is applied among those nearby candidates.
+        """
+        start_time = time.perf_counter()
+        self.used_fallback = False
+        # The grid is kept on the Frame so it is only built once, when the frame is first used as the previous frame.
+        if f1.grid is None or f1.grid.cell_size != self.gate_radius:
+            f1.grid = PointGrid(f1.pts, self.gate_radius)
+        query, train = f1.grid.candidates(f2.pts)
+
+        # Distance test, the candidates came from a square of cells so drop the corners outside the gate.
+        deltas = f1.pts[train] - f2.pts[query]
+        keep = np.einsum("ij,ij->i", deltas, deltas) < self.gate_radius * self.gate_radius
+        query, train = query[keep], train[keep]
+
+        # Hamming distance between each candidate pair of descriptors.
+        # With only a few nearby candidates there is almost always a unique best one, so weak matches are dropped by distance too.
+        distances = hamming_distance(f1.des[train], f2.des[query])
+        keep = distances <= self.max_hamming
+        query, train, distances = query[keep], train[keep], distances[keep]
+        match_time = time.perf_counter()
+        self.timings["match"] = match_time - start_time
+
+        # Lowe's ratio test among the candidates of each query, sorted by query then distance.
+        order = np.lexsort((distances, query))
+        query, train, distances = query[order], train[order], distances[order]
+        is_first = np.ones(len(query), dtype=bool)
+        is_first[1:] = query[1:] != query[:-1]
+        first = np.flatnonzero(is_first)
+        # The pair after a query's best is its second best, unless it belongs to the next query.
+        has_second = np.append(~is_first[1:], False)[first] if len(query) > 0 else np.empty(0, dtype=bool)
+        keep = np.ones(len(first), dtype=bool)
+        keep[has_second] = distances[first[has_second]] < 1.0*distances[first[has_second] + 1]
+        idx1, idx2, distances = train[first[keep]], query[first[keep]], distances[first[keep]]
+        self.timings["filter"] = time.perf_counter() - match_time
+
+        if len(idx1) < max(10, self.min_grid_match_ratio * len(f1.pts)):
+            return self._filter_matches_fallback(f1, f2)
+        return idx1, idx2, distances
+
+    def _filter_matches_fallback(self, f1, f2):
+        """
+        Used by the grid matcher when the motion between frames is larger than gate_radius.
+        Matches all descriptors through an approximate LSH index and gates at fallback_gate_radius.
+        """
+        start_time = time.perf_counter()
+        self.used_fallback = True
+        matches = self.fallback_matcher.knnMatch(f1.des, f2.des, k=2)
+        match_time = time.perf_counter()
+        self.timings["match"] += match_time - start_time
+
+        # LSH can return fewer than two neighbours for a descriptor, in which case the ratio test passes.
+        good = [m[0] for m in matches if len(m) == 1 or (len(m) == 2 and m[0].distance < 1.0*m[1].distance)]
+        idx1 = np.array([m.queryIdx for m in good], dtype=np.intp)
+        idx2 = np.array([m.trainIdx for m in good], dtype=np.intp)
+        distances = np.array([m.distance for m in good], dtype=np.float32)
+
+        deltas = f1.pts[idx1] - f2.pts[idx2]
+        keep = np.sqrt(np.einsum("ij,ij->i", deltas, deltas)) < self.fallback_gate_radius
+        self.timings["filter"] += time.perf_counter() - match_time
+
+        return idx1[keep], idx2[keep], distances[keep]
+
+
+# Shared by the module level extract and match_frames functions so callers that do not own a FeatureExtractor still reuse one.
+_default_extractor = None
+
+def get_default_extractor():
+    global _default_extractor
+    if _default_extractor is None:
+        _default_extractor = FeatureExtractor()
+    return _default_extractor
+
+def extract(img):
+    return get_default_extractor().extract(img)
 
 def normalize(Kinv, pts):
     # The inverse camera intrinsic matrix 𝐾 − 1 transforms 2D homogeneous points 
@@ -51,52 +417,17 @@ def denormalize(K, pt):
     return int(round(ret[0])), int(round(ret[1]))
 
 def match_frames(f1, f2):
-    bf = cv2.BFMatcher(cv2.NORM_HAMMING)
-    matches = bf.knnMatch(f1.des, f2.des, k=2)
-
-    # Lowe's ratio test
-    ret = []
-    idx1, idx2 = [], []
-    for m, n in matches:
-        if m.distance < 1.0*n.distance:
-            p1 = f1.pts[m.queryIdx]
-            p2 = f2.pts[m.trainIdx]
-            
-            # Distance test
-            # Additional distance test, ensuring that the 
-            # Euclidean distance between p1 and p2 is less than 0.1
-            if np.linalg.norm((p1-p2)) < 0.1:
-                # Keep idxs
-                idx1.append(m.queryIdx)
-                idx2.append(m.trainIdx)
-                ret.append((p1, p2))
-                pass
-
-
-    if len(ret) < 10:
-        # print("Not enough matches")
-        return None, None
-    ret = np.array(ret)
-    idx1 = np.array(idx1)
-    idx2 = np.array(idx2)
-    # Fit matrix
-    model, inliers = ransac((ret[:, 0], 
-                            ret[:, 1]), FundamentalMatrixTransform, 
-                            min_samples=8, residual_threshold=0.005, 
-                            max_trials=200)
-    
-    # Ignore outliers
-    ret = ret[inliers]
-
-    return idx1[inliers], idx2[inliers]
+    return get_default_extractor().match(f1, f2)
 
 
 class Frame(object):
-    def __init__(self, img, K):
+    def __init__(self, img, K, extractor=None):
         self.K = K
         self.Kinv = np.linalg.inv(self.K)
+        # PointGrid of self.pts, built by the grid matcher when this frame is matched as the previous frame.
+        self.grid = None
 
-        pts, self.des = extract(img)
-        
-        if self.des.any()!=None:
-            self.pts = normalize(self.Kinv, pts)
\ No newline at end of file
+        if extractor is None:
+            extractor = get_default_extractor()
+        pts, self.des = extractor.extract(img)
+        self.pts = normalize(self.Kinv, pts)
\ No newline at end of file
@@ -1,34 +1,122 @@
+import argparse
+import collections
+import concurrent.futures
+
 import cv2
-from PIL import Image
-
-video = "Test_300_300.mp4"
-cap = cv2.VideoCapture(video)
-fps = cap.get(cv2.CAP_PROP_FPS)
-frames = []
-
-GIF_speedup_factor = 4
-num_skipped_frames = 2
-num_frames = 0
-
-while True:
-    for _ in range(num_skipped_frames):
-        cap.grab()
-    ret, frame = cap.read()
-    if not ret:
-        print("Could not get frame.")
-        break
-    # Convert BGR to RGB
-    frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-    frame_resized = cv2.resize(frame_rgb, (1920//2, 1080//2), interpolation=cv2.INTER_AREA)
-    frame_cropped = frame_resized[:, 1920//8:3*1920//8, :]  # Crop to 1600x800
-    frames.append(Image.fromarray(frame_cropped))
-    cv2.imshow("Frame", frame_cropped)
-    cv2.waitKey(1)
-    num_frames += 1
-
-cap.release()
-print(f"Extracted {num_frames} frames from video.")
-# Save as GIF
-frames[0].save(video.replace(".mp4", ".gif"), save_all=True, append_images=frames[1:], 
-               duration=5, loop=0)  # duration in ms per frame
-print("Saved GIF")
\ No newline at end of file
+import numpy as np
+from PIL import GifImagePlugin, Image
+
+# Converts a video (e.g. a recorded flight) to a GIF for the README.
+# Frames are encoded and written one at a time as they are decoded, so memory use does not grow with the length of the
+# clip: at most a few frames are being resized and quantized by the worker threads at any time. By default every frame
+# is mapped onto the palette of the first frame, which skips computing a new palette per frame and keeps the file small.
+#
+# Example, the settings the README GIFs were made with (1920x1080 input, half size, cropped to the middle quarter):
+#   python helpers/mp4_to_GIF.py Test_300_300.mp4 --stride 3 --speedup 4 --width 960 --crop 240 0 480 540
+
+
+def prepare_frame(frame, width, crop, palette_image, dither):
+    """
+    Resizes, crops and quantizes one BGR frame. Runs on the worker threads.
+
+    Returns: P mode PIL image.
+    """
+    if width is not None and width != frame.shape[1]:
+        height = round(frame.shape[0] * width / frame.shape[1])
+        frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+    if crop is not None:
+        x, y, w, h = crop
+        frame = frame[y:y + h, x:x + w]
+    image = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+    if palette_image is None:
+        return image.quantize(256, dither=dither)
+    return image.quantize(palette=palette_image, dither=dither)
+
+
+def read_frames(cap, start_frame, end_frame, stride):
+    """
+    Yields (frame number, frame) for every stride-th frame from start_frame up to end_frame. Skipped frames are only
+    grabbed, not decoded.
+    """
+    if start_frame > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+    frame_number = start_frame
+    while end_frame is None or frame_number < end_frame:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        yield frame_number, frame
+        for _ in range(stride - 1):
+            cap.grab()
+        frame_number += stride
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Streams a video into a GIF in constant memory.")
+    parser.add_argument("video")
+    parser.add_argument("--output", help="GIF file, the video name with .gif by default")
+    parser.add_argument("--start", type=float, default=0.0, help="Start time in seconds")
+    parser.add_argument("--end", type=float, help="End time in seconds, the end of the video by default")
+    parser.add_argument("--stride", type=int, default=3, help="Use every stride-th frame")
+    parser.add_argument("--speedup", type=float, default=4, help="Playback speed of the GIF relative to the video")
+    parser.add_argument("--width", type=int, help="Resize the frames to this width before cropping")
+    parser.add_argument("--crop", type=int, nargs=4, metavar=("X", "Y", "W", "H"), help="Crop of the resized frame")
+    parser.add_argument("--palette", choices=["first", "per-frame"], default="first",
+                        help="Reuse the palette of the first frame, or compute a palette for every frame (much slower)")
+    parser.add_argument("--dither", action="store_true", help="Floyd-Steinberg dithering, slower and larger but smoother")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--preview", action="store_true", help="Show the frames while exporting")
+    args = parser.parse_args()
+
+    output = args.output or args.video.rsplit(".", 1)[0] + ".gif"
+    cap = cv2.VideoCapture(args.video)
+    if not cap.isOpened():
+        parser.error(f"Could not open {args.video}")
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30
+    start_frame = int(args.start * fps)
+    end_frame = int(args.end * fps) if args.end is not None else None
+    # GIF frame delays are in hundredths of a second
+    duration = max(20, round(1000 * args.stride / fps / args.speedup / 10) * 10)
+    dither = Image.Dither.FLOYDSTEINBERG if args.dither else Image.Dither.NONE
+
+    frames = read_frames(cap, start_frame, end_frame, args.stride)
+    first = next(frames, None)
+    if first is None:
+        parser.error("No frames in the selected range")
+    first_image = prepare_frame(first[1], args.width, args.crop, None, dither)
+    palette_image = first_image if args.palette == "first" else None
+
+    num_frames = 0
+    with open(output, "wb") as fp, concurrent.futures.ThreadPoolExecutor(args.workers) as pool:
+        header, _ = GifImagePlugin.getheader(first_image, info={"loop": 0, "optimize": False})
+        fp.write(b"".join(header))
+
+        def write(image):
+            # Frames using the global palette need no color table of their own
+            fp.write(b"".join(GifImagePlugin.getdata(image, duration=duration, include_color_table=palette_image is None)))
+            if args.preview:
+                cv2.imshow("Frame", cv2.cvtColor(np.asarray(image.convert("RGB")), cv2.COLOR_RGB2BGR))
+                cv2.waitKey(1)
+
+        write(first_image)
+        num_frames += 1
+        # Frames are submitted in order and written in order. Only a bounded number are in flight at once.
+        pending = collections.deque()
+        for _, frame in frames:
+            pending.append(pool.submit(prepare_frame, frame, args.width, args.crop, palette_image, dither))
+            if len(pending) >= 2 * args.workers:
+                write(pending.popleft().result())
+                num_frames += 1
+        while pending:
+            write(pending.popleft().result())
+            num_frames += 1
+        fp.write(b";") # GIF trailer
+
+    cap.release()
+    if args.preview:
+        cv2.destroyAllWindows()
+    print(f"Saved {num_frames} frames to {output}")
+
+
+if __name__ == "__main__":
+    main()
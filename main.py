@@ -1,17 +1,30 @@
 import keyboard
 import time
 import cv2
-import threading
 
 from FlightController import FlightController
+from FlightRecorder import FlightRecorder
+from FrameRecorder import FrameRecorder
+from FrameSource import FrameSource
 from PIDController import PIDController
+from PreviewDisplay import PreviewDisplay
 from VelocityEstimator import VelocityEstimator
+from VelocityFilter import VelocityFilter
+from VisionWorker import VisionWorker
+import tracing
 
+# Change in measured velocity per second per unit of PID output, from the drone model of test_PID.py: the velocity
+# changes by 0.01 per second per unit of roll away from the true center. The sign is positive since trim = 128 - output
+# and the image moves opposite to the drone, so a larger output makes the measured velocity go up.
+PLANT_GAIN = 0.01
 
-def handle_keyboard_input(flight_controller : FlightController):
+
+def handle_keyboard_input(flight_controller : FlightController, auto_pilot_enabled=False):
     """
     Process keyboard input and updates the flight controller's command state accordingly. 
     :param flight_controller: FlightController: The flight controller instance to update based on keyboard input.
+    :param auto_pilot_enabled: While the autopilot is on and no key is pressed, the roll is left to the autopilot instead
+                               of being reset to the trim center. Any key press hands the roll back to the keyboard.
 
     Returns: True if any relevant key is pressed, otherwise False.
     
@@ -117,69 +130,41 @@ def handle_keyboard_input(flight_controller : FlightController):
     if keyboard.is_pressed('g'):
         is_gyro_correction = True
         key_pressed = True
+    if auto_pilot_enabled and not key_pressed:
+        control_roll = None # Owned by the autopilot, which sets it after each estimate
     flight_controller.set_command_state(control_turn, control_accelerator, control_roll, control_pitch,
                                        is_fast_fly, is_fast_drop, is_emergency_stop, is_circle_turn_end, is_no_head_mode, is_gyro_correction)        
     return key_pressed
 
 
-def get_latest_frame(cap, lock, counter):
-    """
-    Docstring for get_latest_frame
-    This function continuously grabs frames from the video capture in a separate thread to ensure that the latest frame is always available for processing.
-    This should be run in a seperate thread. If this is not run, the buffer fills and frames read will be late.
-    As long as the processing thread does not block the GIL too long, this should allow the main thread to always have access to the latest frame without significant delay.
-    
-    :param cap: cv2 VideoCapture object for reading video frames.
-    :param lock: threading.Lock object to synchronize access to the video capture.
-    :param counter: List containing a single integer to keep track of the number of frames captured. 
-                    This is used to determine how many frames have been grabbed and skipped during video processing.
-    """
-    while True:
-        with lock:
-            cap.grab()
-            counter[0] += 1
-        time.sleep(0.001)
-
-if __name__ == "__main__":
+def run_autopilot_loop(flight_controller, velocity_estimator, pid_controller, frame_source, preview, vision_worker=None,
+                       velocity_filter=None, flight_recorder=None, frames_to_skip=2, time_between_frames=0.05):
     """
-    main initializes the FlightController, VelocityEstimator, and PIDController. 
-    It starts a separate thread to continuously grab frames from the drone's video feed to ensure the latest frame is always available for processing. 
-    The main loop handles any keyboard input, and disables autopilot if any key is pressed.
-    Pressing 'p' toggles autopilot mode. 
-    When autopilot is enabled, the following is performed
-    - retrieve the latest frame from the video feed
-    - estimate the drone's velocity using the VelocityEstimator
-    - update the PIDController with the estimated velocity to get control output
-    - adjust the drone's roll based on the PID control output to maintain stable flight
+    The main loop: handles the keyboard, toggles autopilot with p and runs an autopilot step on every loop while it is
+    enabled, until escape is pressed or q is pressed in the preview. The flight controller's sender must already be running.
 
-    The loop then tells the flight controller to send the latest control packet to the drone.
+    :param vision_worker: Optional VisionWorker to run the velocity estimation in instead of velocity_estimator.
+    :param velocity_filter: Optional VelocityFilter the PID controller runs on.
+    :param flight_recorder: Optional FlightRecorder every autopilot step is logged to.
+    :param frames_to_skip: The velocity is estimated between frames at least this many frames apart.
+    :param time_between_frames: Minimum time between loop iterations, in seconds.
     """
-
-    flight_controller = FlightController()
-    # velocity_estimator = VelocityEstimator(method="optical_flow")
-    # pid_controller = PIDController(kp=0.5, ki=1, kd=0.05) # kp=0.5, ki=1, kd=0.05
-
-    velocity_estimator = VelocityEstimator(method="feature_matching")
-    pid_controller = PIDController(kp=300, ki=300, kd=10) # kp=300, ki=300, kd=10 
-
-    drone_url = "rtsp://192.168.1.1:7070/webcam"
-    cap = cv2.VideoCapture(drone_url)
-    capture_lock = threading.Lock()
-    counter = [0]
-    threading.Thread(target=get_latest_frame, args=(cap, capture_lock, counter), daemon=True).start()
-
     auto_pilot_enabled = False
     p_is_pressed = False
     last_frame_num = 0
-    frames_to_skip = 2
-    time_between_frames = 0.05
     while True:
         start_time = time.time()
-        key_pressed = handle_keyboard_input(flight_controller)
+        loop_start = time.perf_counter()
+        with tracing.span("keyboard"):
+            key_pressed = handle_keyboard_input(flight_controller, auto_pilot_enabled)
         if key_pressed:
             auto_pilot_enabled = False
             pid_controller.reset()
             velocity_estimator.previous_frame = None
+            if vision_worker is not None:
+                vision_worker.reset()
+            if velocity_filter is not None:
+                velocity_filter.reset()
 
         if keyboard.is_pressed('p'): # Toggle autopilot mode
             if not p_is_pressed:
@@ -187,57 +172,166 @@ if __name__ == "__main__":
                 auto_pilot_enabled = not auto_pilot_enabled
                 pid_controller.reset()
                 velocity_estimator.previous_frame = None
+                if vision_worker is not None:
+                    vision_worker.reset()
+                if velocity_filter is not None:
+                    velocity_filter.reset()
             p_is_pressed = True
         else:
             p_is_pressed = False
 
         if auto_pilot_enabled:
-            with capture_lock:
-                curr_frame_num = counter[0]
-                # Skip frames to amplify difference between images if the drone is moving slowly.
-                skipped_frames = curr_frame_num - last_frame_num
-                if skipped_frames < frames_to_skip:
-                    for _ in range(frames_to_skip - skipped_frames):
-                        cap.grab()
-                last_frame_num = curr_frame_num
-                ret, img2 = cap.retrieve()
-            if not ret:
+            # Skip frames to amplify difference between images if the drone is moving slowly.
+            # Waits until the latest frame is at least frames_to_skip frames after the last one processed.
+            with tracing.span("wait_frame"):
+                frame = frame_source.latest_newer_than(last_frame_num + frames_to_skip - 1, timeout=1.0)
+            if frame is None:
                 print("Failed to read frame")
                 continue
+            last_frame_num, capture_time, img2 = frame
 
             # Estimate the velocity and update the PID controller
             # Use the PID controller to adjust the drone's roll
-            velocity = velocity_estimator.estimate_velocity(img2)
-            if velocity is not None:
-                control_output = pid_controller.update(velocity)
+            if vision_worker is not None:
+                # The worker answers asynchronously, so the result is usually for an earlier frame (result["seq"]).
+                vision_worker.submit(img2, last_frame_num, capture_time)
+                result = vision_worker.poll()
+                # Everything below describes the frame of the result, or no frame if there is no new result
+                seq, capture_time, velocity, variance, inliers = -1, float("nan"), None, None, -1
+                if result is not None:
+                    seq, capture_time, velocity = result["seq"], result["capture_time"], result["velocity"]
+                    variance, inliers = result["variance"], result["inliers"]
+                estimated = result is not None
+            else:
+                with tracing.span("estimate_velocity"):
+                    velocity = velocity_estimator.estimate_velocity(img2)
+                seq, variance, inliers = last_frame_num, velocity_estimator.variance, velocity_estimator.inliers
+                estimated = True
+            if velocity_filter is not None:
+                # The filter predicts through failed estimates, so the controller runs on every loop
+                if velocity is not None:
+                    velocity_filter.update(velocity, variance, capture_time)
+                elif estimated:
+                    velocity_filter.miss()
+                now = time.monotonic()
+                control_output = pid_controller.update(velocity_filter.predict(now), timestamp=now)
+                velocity_filter.predict(now, control_output)
+                flight_controller.set_command_state(control_roll=128 - int(control_output))
+                preview.set_status(velocity=velocity_filter.velocity, trim=128 - int(control_output))
+            elif velocity is not None:
+                # The controller's dt follows the capture times of the frames, not the time the estimate is done
+                control_output = pid_controller.update(velocity, timestamp=capture_time)
                 trim = 128 - int(control_output)
                 print("Trim: ", trim, f"Velocity: {velocity:.4f}")
                 flight_controller.set_command_state(control_roll=trim)
+                preview.set_status(velocity=velocity, trim=trim)
             else:
                 print("Velocity estimation failed, skipping PID update.")
 
-            # This should be commented out if the processing is running slow
-            cv2.imshow("Drone Camera", img2)
-            if cv2.waitKey(1) & 0xFF == ord('q'):
-                break
-        
-        # If autopilot isnt running, show the drone's video feed.
-        if not auto_pilot_enabled:
-            with capture_lock:
-                ret, img2 = cap.retrieve()
-                if ret:
-                    cv2.imshow("Drone Camera", img2)
-                    if cv2.waitKey(1) & 0xFF == ord('q'):
-                        break
-        
+            if flight_recorder is not None:
+                # The variance and inliers are left over from the last success when the estimate failed
+                if velocity is None:
+                    variance, inliers = None, -1
+                flight_recorder.log(flight_controller, pid_controller, seq, capture_time, velocity, variance, inliers)
+
+        # Press q in the preview window to exit
+        if preview.quit_requested:
+            break
+
         # Press escape to exit the program. Note that the drone will stop receiving control packets, which should cause it to hover or crash.
         if keyboard.is_pressed("esc"):
             print("Exiting program")
             break
 
-        flight_controller.send_control_packet()
+        loop_end = time.perf_counter()
+        tracing.record("loop", loop_start, loop_end)
+        preview.set_status(autopilot=auto_pilot_enabled, loop_ms=(loop_end - loop_start) * 1000)
         end_time = time.time()
-        time.sleep(max(0, time_between_frames - (end_time - start_time))) # If processing is fast, wait before sending the next packet
+        time.sleep(max(0, time_between_frames - (end_time - start_time))) # If processing is fast, wait before handling the next frame
+
+
+if __name__ == "__main__":
+    """
+    main initializes the FlightController, VelocityEstimator, and PIDController. 
+    It starts a FrameSource, which decodes the drone's video feed on its own thread so the latest frame is always available for processing. 
+    The main loop handles any keyboard input, and disables autopilot if any key is pressed.
+    Pressing 'p' toggles autopilot mode. 
+    When autopilot is enabled, the following is performed
+    - retrieve the latest frame from the video feed
+    - estimate the drone's velocity using the VelocityEstimator
+    - update the PIDController with the estimated velocity to get control output
+    - adjust the drone's roll based on the PID control output to maintain stable flight
+
+    The flight controller's sender thread sends the latest control packet to the drone at a fixed rate, so slow frames do not delay the control link.
+    """
+
+    flight_controller = FlightController()
+    # velocity_estimator = VelocityEstimator(method="optical_flow")
+    # velocity_estimator = VelocityEstimator(method="optical_flow", flow_backend="dis") # About 2 ms of flow per frame instead of 30 ms
+    # pid_controller = PIDController(kp=0.5, ki=1, kd=0.05) # kp=0.5, ki=1, kd=0.05
+
+    # velocity_estimator = VelocityEstimator(method="sparse_flow") # Cheaper than feature matching, fast enough to run on every frame
+
+    velocity_estimator = VelocityEstimator(method="feature_matching")
+    # Only roll is automated. The same feature matches also give the rest of each frame's motion in
+    # velocity_estimator.motion (variances in velocity_estimator.motion_variance): with the camera facing forward, scale
+    # is forward motion for pitch hold and y is altitude change for throttle hold, with PID controllers of their own.
+    # Yaw turns the scene sideways like the roll drift, so it shows up in x rather than in rotation.
+    # trim = 128 - output is kept within the packet's 1-255 range, with anti-windup while it is saturated.
+    # Setting plant_gain (measured velocity change per second per unit of output, PLANT_GAIN, positive since a larger
+    # output rolls the drone so that the image moves the other way) also predicts each measurement forward by its vision
+    # latency, using the capture time of its frame.
+    pid_controller = PIDController(kp=300, ki=300, kd=10, output_limits=(-127, 127)) # kp=300, ki=300, kd=10 
+
+    # Set to True to run the velocity estimation in a separate process (see VisionWorker.py), so a slow vision frame
+    # does not hold the GIL needed by the keyboard polling, the frame source and the packet sender.
+    use_vision_worker = False
+    vision_worker = VisionWorker(method=velocity_estimator.method) if use_vision_worker else None
+
+    # Set to True to run the PID controller on every loop on a Kalman filtered velocity (see VelocityFilter.py), which
+    # fuses the vision estimates with the roll commands, instead of only when a new estimate succeeds.
+    use_velocity_filter = False
+    velocity_filter = VelocityFilter(plant_gain=PLANT_GAIN) if use_velocity_filter else None
+
+    # Set to a file name, e.g. "flight.npy", to log the estimate, PID terms and command state of every autopilot step
+    # to a memory mapped flight data recorder. Summarize logs with: python FlightRecorder.py flight.npy
+    flight_log_path = None
+    flight_recorder = FlightRecorder(flight_log_path) if flight_log_path is not None else None
+
+    # Set to a file name, e.g. "trace.json", to record where each loop iteration spends its time (see tracing.py).
+    # The trace is written on exit and opens in https://ui.perfetto.dev or chrome://tracing.
+    trace_path = None
+    if trace_path is not None:
+        tracing.enable()
+
+    drone_url = "rtsp://192.168.1.1:7070/webcam"
+    # A recorded video or SyntheticCapture() can be used instead of the url to run the pipeline offline.
+    # To fly without the drone, start a DroneSimulator (see DroneSimulator.py), use simulator.camera() instead of the
+    # url and point flight_controller.control_packet_ip and control_packet_port at simulator.address.
+    # FFmpegCapture(drone_url, resolution=(velocity_estimator.W, velocity_estimator.H)) decodes straight to the working
+    # resolution in grayscale if ffmpeg is installed. The preview is then shown in grayscale too.
+    # Set record_path, e.g. "flight.mp4", to record the feed in the background while flying. With FFmpegCapture, pass
+    # record_path="flight.mkv" to it instead to save the original stream without re-encoding.
+    record_path = None
+    recorder = FrameRecorder(record_path) if record_path is not None else None
+    frame_source = FrameSource(drone_url, recorder=recorder).start()
+    # The video feed is shown on its own thread at a limited rate, with the velocity, trim and loop time drawn on top.
+    # Set headless=True to run without a window.
+    preview = PreviewDisplay(frame_source, headless=False).start()
+
+    packet_rate = 20 # Control packets per second
+    flight_controller.start_sender(packet_rate)
+
+    run_autopilot_loop(flight_controller, velocity_estimator, pid_controller, frame_source, preview, vision_worker,
+                       velocity_filter, flight_recorder)
     
-    cap.release()
-    cv2.destroyAllWindows()
\ No newline at end of file
+    flight_controller.stop_sender()
+    preview.stop()
+    frame_source.stop()
+    if flight_recorder is not None:
+        flight_recorder.close()
+    if vision_worker is not None:
+        vision_worker.close()
+    cv2.destroyAllWindows()
+    if trace_path is not None:
+        print(f"Saved {tracing.export_chrome_trace(trace_path)} spans to {trace_path}")
\ No newline at end of file
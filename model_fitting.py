@@ -0,0 +1,207 @@
+import cv2
+import numpy as np
+
+# Robust model fitting backends used by FeatureExtractor to reject outlier matches.
+# Every backend takes the matched points of the previous and current frame (N x 2, normalized image coordinates),
+# sorted from the best to the worst descriptor distance, and returns (model, inliers) where inliers is a boolean mask.
+# model is None when the fit fails.
+#
+# - skimage: the original scikit-image ransac with a FundamentalMatrixTransform. scikit-image is only imported when
+#            this backend is used, so it is not needed otherwise.
+# - usac_fundamental: OpenCV's USAC fundamental matrix estimator with PROSAC sampling, which draws its samples from
+#                     the best matches first and widens the pool as it goes.
+# - usac_homography: OpenCV's USAC homography estimator with PROSAC sampling.
+# - affine: a partial affine (rotation, uniform scale and translation) consensus. Samples two matches at a time from a
+#           growing pool of the best matches like the translation backend, and refits on the inliers with least squares.
+#           OpenCV's estimateAffinePartial2D only samples uniformly.
+# - translation: a pure translation consensus. Samples one match at a time, taking them in descriptor distance
+#                order from a pool that grows with each trial (like PROSAC), and stops as soon as enough trials have
+#                been run for the current best inlier ratio.
+
+rng = np.random.default_rng()
+
+# OpenCV older than 4.5.1 does not have USAC, fall back to plain RANSAC there.
+# PROSAC occasionally finds no model when the best matches are degenerate (e.g. all along one line), and the fit is
+# then retried once with MAGSAC++, which samples uniformly.
+USAC_METHOD = getattr(cv2, "USAC_PROSAC", cv2.RANSAC)
+USAC_RETRY_METHOD = getattr(cv2, "USAC_MAGSAC", cv2.RANSAC)
+
+# Smallest mean squared spread of the matched points, in normalized coordinates, that a scale and rotation are fitted to.
+MIN_SPREAD = 1e-10
+
+
+def scale_matrix(residual_threshold):
+    # The OpenCV estimators expect thresholds of around a pixel and find no inliers with the tiny thresholds of
+    # normalized coordinates. The points are scaled so that residual_threshold becomes 1 and the model is scaled back.
+    return np.diag([1.0 / residual_threshold, 1.0 / residual_threshold, 1.0])
+
+
+def fit_skimage_fundamental(p1, p2, residual_threshold, max_trials, confidence):
+    from skimage.measure import ransac
+    from skimage.transform import FundamentalMatrixTransform
+
+    model, inliers = ransac((p1, p2), FundamentalMatrixTransform,
+                            min_samples=8, residual_threshold=residual_threshold,
+                            max_trials=max_trials)
+    if inliers is None:
+        return None, np.zeros(len(p1), dtype=bool)
+    return model, inliers
+
+
+def run_usac(estimate, n):
+    """
+    Runs estimate(method) with USAC_METHOD and, if that finds no model, with USAC_RETRY_METHOD.
+
+    Returns: (model, inliers as a boolean mask), or (None, all False) if neither finds a model.
+    """
+    for method in (USAC_METHOD, USAC_RETRY_METHOD):
+        try:
+            model, inliers = estimate(method)
+        except cv2.error:
+            # USAC asserts instead of failing when every sample is degenerate, e.g. a handful of matches with the same motion
+            continue
+        if inliers is not None and model is not None:
+            return model, inliers.ravel().astype(bool)
+    return None, np.zeros(n, dtype=bool)
+
+
+def fit_usac_fundamental(p1, p2, residual_threshold, max_trials, confidence):
+    S = scale_matrix(residual_threshold)
+    model, inliers = run_usac(lambda method: cv2.findFundamentalMat(p1 * S[0, 0], p2 * S[0, 0], method, 1.0, confidence, max_trials),
+                              len(p1))
+    if model is None:
+        return None, inliers
+    return S @ model[:3] @ S, inliers
+
+
+def fit_usac_homography(p1, p2, residual_threshold, max_trials, confidence):
+    S = scale_matrix(residual_threshold)
+    model, inliers = run_usac(lambda method: cv2.findHomography(p1 * S[0, 0], p2 * S[0, 0], method, 1.0, maxIters=max_trials,
+                                                                confidence=confidence),
+                              len(p1))
+    if model is None:
+        return None, inliers
+    return np.linalg.inv(S) @ model @ S, inliers
+
+
+def fit_affine(p1, p2, residual_threshold, max_trials, confidence):
+    n = len(p1)
+    best_count = 0
+    best_inliers = np.zeros(n, dtype=bool)
+    if n < 3:
+        return None, best_inliers
+    needed_trials = max_trials
+    # Same progressive pool as fit_translation, starting from the best tenth of the matches.
+    min_pool = min(n, max(10, n // 10))
+    threshold_sq = residual_threshold * residual_threshold
+
+    trial = 0
+    while trial < needed_trials:
+        trial += 1
+        pool = min_pool + (n - min_pool) * (trial - 1) // max_trials
+        i, j = rng.choice(pool, 2, replace=False)
+        # The rotation and scale that map the vector between the two matches in the previous frame onto the current one
+        d1, d2 = p1[j] - p1[i], p2[j] - p2[i]
+        length_sq = d1 @ d1
+        if length_sq <= MIN_SPREAD:
+            continue
+        a = (d1 @ d2) / length_sq
+        b = (d1[1] * d2[0] - d1[0] * d2[1]) / length_sq
+        R = np.array([[a, b], [-b, a]])
+        residuals = p2 - p1 @ R.T - (p2[i] - R @ p1[i])
+        inliers = np.einsum("ij,ij->i", residuals, residuals) < threshold_sq
+        count = np.count_nonzero(inliers)
+        if count > best_count:
+            best_count = count
+            best_inliers = inliers
+            # Trials needed to draw two inliers with the given confidence.
+            inlier_ratio = count / n
+            if inlier_ratio >= 1.0:
+                break
+            needed_trials = min(max_trials, int(np.ceil(np.log(1 - confidence) / np.log(1 - inlier_ratio ** 2))))
+
+    # Refit on the inliers and recompute them once.
+    model, _ = fit_similarity_least_squares(p1[best_inliers], p2[best_inliers])
+    if model is None:
+        return None, np.zeros(n, dtype=bool)
+    residuals = p2 - p1 @ model[:, :2].T - model[:, 2]
+    inliers = np.einsum("ij,ij->i", residuals, residuals) < threshold_sq
+    if np.count_nonzero(inliers) < best_count:
+        inliers = best_inliers
+    return model, inliers
+
+
+def fit_translation(p1, p2, residual_threshold, max_trials, confidence):
+    deltas = p2 - p1
+    n = len(deltas)
+    best_count = 0
+    best_inliers = np.zeros(n, dtype=bool)
+    needed_trials = max_trials
+    # Start by sampling from the best tenth of the matches and grow the pool to all of them by the last trial.
+    min_pool = min(n, max(10, n // 10))
+    threshold_sq = residual_threshold * residual_threshold
+
+    trial = 0
+    while trial < needed_trials:
+        pool = min_pool + (n - min_pool) * trial // max_trials
+        residuals = deltas - deltas[rng.integers(pool)]
+        inliers = np.einsum("ij,ij->i", residuals, residuals) < threshold_sq
+        count = np.count_nonzero(inliers)
+        if count > best_count:
+            best_count = count
+            best_inliers = inliers
+            # Trials needed to draw at least one inlier with the given confidence.
+            inlier_ratio = count / n
+            if inlier_ratio >= 1.0:
+                break
+            needed_trials = min(max_trials, int(np.ceil(np.log(1 - confidence) / np.log(1 - inlier_ratio))))
+        trial += 1
+
+    if best_count == 0:
+        return None, best_inliers
+
+    # Refit on the inliers and recompute them once.
+    model = deltas[best_inliers].mean(axis=0)
+    residuals = deltas - model
+    inliers = np.einsum("ij,ij->i", residuals, residuals) < threshold_sq
+    if np.count_nonzero(inliers) < best_count:
+        inliers = best_inliers
+    return model, inliers
+
+
+def fit_similarity_least_squares(p1, p2):
+    """
+    Least squares fit of p2 = [[a, b], [-b, a]] @ p1 + t (rotation, uniform scale and translation, the model of fit_affine)
+    to matches that are already inliers. Closed form, so it is cheap enough to run on every frame after the robust fit.
+
+    Returns: (model, variances), where model is the 2x3 matrix and variances are the variances of (tx, ty, a, b) from the
+             spread of the residuals, or (None, None) if there are fewer than 3 matches or the points of either frame
+             are all at one point, where the scale and rotation are undefined.
+    """
+    n = len(p1)
+    if n < 3:
+        return None, None
+    m1, m2 = p1.mean(axis=0), p2.mean(axis=0)
+    q1, q2 = p1 - m1, p2 - m2
+    spread = np.einsum("ij,ij->", q1, q1)
+    if spread <= MIN_SPREAD * n or np.einsum("ij,ij->", q2, q2) <= MIN_SPREAD * n:
+        return None, None
+    a = np.einsum("ij,ij->", q1, q2) / spread
+    b = (q1[:, 1] @ q2[:, 0] - q1[:, 0] @ q2[:, 1]) / spread
+    R = np.array([[a, b], [-b, a]])
+    t = m2 - R @ m1
+    residuals = q2 - q1 @ R.T
+    # 2n equations and 4 parameters. a and b are estimated about the centroid, so t also carries their error times m1.
+    sigma_sq = np.einsum("ij,ij->", residuals, residuals) / max(2 * n - 4, 1)
+    var_ab = sigma_sq / spread
+    var_t = sigma_sq / n + var_ab * (m1 @ m1)
+    return np.hstack([R, t[:, None]]), np.array([var_t, var_t, var_ab, var_ab])
+
+
+FIT_BACKENDS = {
+    "skimage": fit_skimage_fundamental,
+    "usac_fundamental": fit_usac_fundamental,
+    "usac_homography": fit_usac_homography,
+    "affine": fit_affine,
+    "translation": fit_translation,
+}
@@ -0,0 +1,169 @@
+import argparse
+import itertools
+import time
+
+import numpy as np
+
+# Batch version of the simulation in test_PID.py. Instead of one gain set in real time, every combination of gains and
+# drone models is simulated at once: each array below holds one value per simulation, and a time step updates all of
+# them with a few NumPy operations. The controller is the same as PIDController.update with an explicit dt.
+#
+# Drone model (from test_PID.py): the roll trim f_0 pushes the drone with a force proportional to its distance from the
+# drone's true center, and quadratic drag slows it down.
+#   dv/dt = (f_0 - true_center) * force_coefficient - alpha * v * |v|
+#
+# Example:
+#   python pid_sweep.py --kp 0 600 13 --ki 0 600 13 --kd 0 40 9 --output pid_sweep.csv
+
+BASE_CONTROLLER_CENTER = 128
+DEFAULT_MODELS = {
+    "true_center": [120, 128, 140],
+    "force_coefficient": [0.005, 0.01, 0.02],
+    "alpha": [50],
+    "v0": [-0.03],
+}
+
+
+def grid(**values):
+    """
+    Returns: dict of flat arrays holding every combination of the given values, e.g. grid(kp=[1, 2], ki=[0, 1]).
+    """
+    names = list(values)
+    combinations = np.array(list(itertools.product(*values.values())), dtype=np.float64).reshape(-1, len(names))
+    return {name: combinations[:, i] for i, name in enumerate(names)}
+
+
+def simulate_batch(kp, ki, kd, true_center, force_coefficient, alpha, v0, dt=0.15, duration=10.0, measurement_delay=0):
+    """
+    Simulates len(kp) closed loops at once. Every argument but dt, duration and measurement_delay is an array with one
+    value per simulation, or a scalar shared by all of them.
+
+    :param dt: Time between control updates in seconds.
+    :param measurement_delay: Number of control updates the velocity measurement lags behind the drone, to mimic vision latency.
+    Returns: velocities, an array of shape (steps, simulations). Diverged simulations contain inf or nan.
+    """
+    kp, ki, kd, true_center, force_coefficient, alpha, v0 = np.broadcast_arrays(
+        *(np.asarray(x, dtype=np.float64) for x in (kp, ki, kd, true_center, force_coefficient, alpha, v0)))
+    steps = int(round(duration / dt))
+    velocities = np.empty((steps, kp.size))
+
+    v = v0.copy()
+    f_0 = np.full(kp.size, float(BASE_CONTROLLER_CENTER))
+    integral = np.zeros(kp.size)
+    previous_error = np.zeros(kp.size)
+    force = np.empty(kp.size)
+    with np.errstate(over="ignore", invalid="ignore"):
+        for step in range(steps):
+            # Physical simulation
+            np.subtract(f_0, true_center, out=force)
+            force *= force_coefficient
+            force -= alpha * v * np.abs(v)
+            v += force * dt
+            velocities[step] = v
+
+            # PID update on the (possibly delayed) measurement, with the setpoint at 0
+            measured = velocities[step - measurement_delay] if step >= measurement_delay else v0
+            error = -measured
+            integral += error * dt
+            output = kp * error + ki * integral + kd * (error - previous_error) / dt
+            previous_error = error
+            np.add(BASE_CONTROLLER_CENTER, output, out=f_0)
+    return velocities
+
+
+def step_metrics(velocities, v0, dt, settle_band=0.005, steady_fraction=0.1):
+    """
+    Computes the response metrics of every simulation.
+
+    :param settle_band: The velocity is settled once it stays within +-settle_band.
+    :param steady_fraction: Fraction of the run at its end used for the steady state error.
+    Returns: dict of arrays with one value per simulation:
+             settling_time (s, inf if never settled), overshoot (how far the velocity crosses past 0, as a fraction of
+             |v0|), steady_state_error (mean |v| at the end of the run) and diverged.
+    """
+    steps = len(velocities)
+    magnitude = np.abs(velocities)
+    diverged = ~np.all(np.isfinite(velocities), axis=0) | (magnitude.max(axis=0, initial=0.0, where=np.isfinite(magnitude)) > 1.0)
+
+    outside = ~(magnitude <= settle_band)
+    # Index of the last step outside the band, -1 if the velocity never left it
+    last_outside = np.where(outside.any(axis=0), steps - 1 - np.argmax(outside[::-1], axis=0), -1)
+    settling_time = np.where(last_outside == steps - 1, np.inf, (last_outside + 1) * dt)
+
+    v0 = np.broadcast_to(np.asarray(v0, dtype=np.float64), velocities.shape[1:])
+    with np.errstate(over="ignore", invalid="ignore", divide="ignore"):
+        crossing = np.nanmax(np.where(np.isfinite(velocities), -np.sign(v0) * velocities, np.nan), axis=0, initial=0.0)
+        overshoot = np.maximum(crossing, 0.0) / np.abs(v0)
+    steady_state_error = magnitude[-max(1, int(steps * steady_fraction)):].mean(axis=0)
+
+    settling_time[diverged] = np.inf
+    overshoot[diverged] = np.inf
+    steady_state_error[diverged] = np.inf
+    return {"settling_time": settling_time, "overshoot": overshoot, "steady_state_error": steady_state_error, "diverged": diverged}
+
+
+def sweep_gains(kp_values, ki_values, kd_values, models=DEFAULT_MODELS, dt=0.15, duration=10.0, measurement_delay=0, settle_band=0.005):
+    """
+    Simulates every gain set against every drone model.
+
+    Returns: (table, worst)
+             table is a dict of columns with one row per (gains, model) combination: the gains, the model parameters and
+             the step_metrics.
+             worst is a dict of columns with one row per gain set: the gains and the worst settling_time, overshoot and
+             steady_state_error over all models.
+    """
+    gains = grid(kp=kp_values, ki=ki_values, kd=kd_values)
+    model_grid = grid(**models)
+    num_gains, num_models = len(gains["kp"]), len(model_grid["v0"])
+    # Row g * num_models + m is gain set g with model m
+    table = {name: np.repeat(column, num_models) for name, column in gains.items()}
+    table.update({name: np.tile(column, num_gains) for name, column in model_grid.items()})
+
+    velocities = simulate_batch(dt=dt, duration=duration, measurement_delay=measurement_delay, **table)
+    table.update(step_metrics(velocities, table["v0"], dt, settle_band))
+
+    worst = dict(gains)
+    for name in ("settling_time", "overshoot", "steady_state_error"):
+        worst[name] = table[name].reshape(num_gains, num_models).max(axis=1)
+    return table, worst
+
+
+def save_table(path, table):
+    names = list(table)
+    np.savetxt(path, np.column_stack([table[name].astype(np.float64) for name in names]),
+               delimiter=",", header=",".join(names), comments="", fmt="%.6g")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulates a grid of PID gains against several drone models at once.")
+    parser.add_argument("--kp", nargs=3, type=float, default=[0, 600, 13], metavar=("MIN", "MAX", "COUNT"))
+    parser.add_argument("--ki", nargs=3, type=float, default=[0, 600, 13], metavar=("MIN", "MAX", "COUNT"))
+    parser.add_argument("--kd", nargs=3, type=float, default=[0, 40, 9], metavar=("MIN", "MAX", "COUNT"))
+    parser.add_argument("--dt", type=float, default=0.15, help="Time between control updates in seconds")
+    parser.add_argument("--duration", type=float, default=10.0, help="Simulated time in seconds")
+    parser.add_argument("--delay", type=int, default=0, help="Measurement delay in control updates")
+    parser.add_argument("--settle-band", type=float, default=0.005)
+    parser.add_argument("--top", type=int, default=10, help="Number of best gain sets printed")
+    parser.add_argument("--output", help="CSV file for the full table")
+    args = parser.parse_args()
+
+    kp_values, ki_values, kd_values = (np.linspace(start, stop, int(count)) for start, stop, count in (args.kp, args.ki, args.kd))
+    start_time = time.perf_counter()
+    table, worst = sweep_gains(kp_values, ki_values, kd_values, dt=args.dt, duration=args.duration,
+                               measurement_delay=args.delay, settle_band=args.settle_band)
+    print(f"Simulated {len(table['kp'])} closed loops in {time.perf_counter() - start_time:.2f} s")
+
+    # Best worst case over the models: shortest settling time, then smallest overshoot
+    order = np.lexsort((worst["overshoot"], worst["settling_time"]))
+    print("kp       ki       kd       settling (s)  overshoot  steady state error")
+    for i in order[:args.top]:
+        print(f"{worst['kp'][i]:<8.1f} {worst['ki'][i]:<8.1f} {worst['kd'][i]:<8.1f} {worst['settling_time'][i]:<13.2f} "
+              f"{worst['overshoot'][i]:<10.2f} {worst['steady_state_error'][i]:.5f}")
+
+    if args.output:
+        save_table(args.output, table)
+        print(f"Saved results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@ import matplotlib.pyplot as plt
 
 # This file simulates a drone's velocity response to changes in trim 
 # Changes in trim come from a PID controller which is trying to maintain a velocity of 0 by adjusting the trim based on the velocity estimate.
+# pid_sweep.py runs the same simulation for a whole grid of gains and drone models at once, without plotting.
 
 
 if __name__ == "__main__":
@@ -33,7 +34,7 @@ if __name__ == "__main__":
         v += f_total * dt
         
         # Update trim
-        trim = pid_controller.update(v) 
+        trim = pid_controller.update(v, dt=dt) # Simulated time, so the plotting does not change the controller's dt
         print("Trim: ", base_controller_center + trim, f"v: {v:.4f}")
         f_0 = base_controller_center + trim
 
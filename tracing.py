@@ -0,0 +1,131 @@
+import itertools
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+# Low overhead tracing of the hot paths, for finding where a loop iteration spends its time.
+# Spans are recorded into preallocated NumPy arrays used as a ring buffer, so recording allocates nothing beyond the
+# span object itself and the oldest spans are overwritten once it is full. The trace is exported as Chrome trace JSON,
+# which opens in https://ui.perfetto.dev or chrome://tracing with one row per thread, so stalls and threads waiting on
+# each other (e.g. for the GIL) show up as gaps on the timeline.
+#
+# Tracing is off by default, and span() and record() then return immediately.
+#
+# Usage:
+#   tracing.enable()
+#   with tracing.span("estimate_velocity"):
+#       ...
+#   tracing.record("fit", start_time, time.perf_counter()) # For code that already takes time.perf_counter() timings
+#   tracing.export_chrome_trace("trace.json")
+
+enabled = False
+
+_names = {} # Span name -> id
+_name_lock = threading.Lock()
+_starts = None
+_ends = None
+_name_ids = None
+_thread_ids = None
+_counter = None
+_thread_names = {}
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, self.start, time.perf_counter())
+        return False
+
+
+def enable(capacity=100000):
+    """
+    Starts recording, keeping the last capacity spans.
+    """
+    global enabled, _starts, _ends, _name_ids, _thread_ids, _counter
+    _starts = np.zeros(capacity)
+    _ends = np.zeros(capacity)
+    _name_ids = np.full(capacity, -1, dtype=np.int32)
+    _thread_ids = np.zeros(capacity, dtype=np.int64)
+    # next() on itertools.count is atomic under the GIL, so threads can claim slots without a lock
+    _counter = itertools.count()
+    _thread_names.clear()
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def span(name):
+    """
+    Returns: a context manager recording the time spent in its block under name.
+    """
+    if not enabled:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def record(name, start, end):
+    """
+    Records a span from start to end, both time.perf_counter() times.
+    """
+    if not enabled:
+        return
+    name_id = _names.get(name)
+    if name_id is None:
+        with _name_lock:
+            name_id = _names.setdefault(name, len(_names))
+    thread_id = threading.get_ident()
+    if thread_id not in _thread_names:
+        _thread_names[thread_id] = threading.current_thread().name
+    i = next(_counter) % len(_starts)
+    _name_ids[i] = -1 # Marks the slot as being written, in case it is exported before it is complete
+    _starts[i] = start
+    _ends[i] = end
+    _thread_ids[i] = thread_id
+    _name_ids[i] = name_id
+
+
+def export_chrome_trace(path):
+    """
+    Writes the recorded spans as Chrome trace event JSON.
+
+    Returns: the number of spans written.
+    """
+    if _starts is None:
+        return 0
+    names = {name_id: name for name, name_id in _names.items()}
+    valid = np.flatnonzero(_name_ids >= 0)
+    valid = valid[np.argsort(_starts[valid], kind="stable")]
+    pid = os.getpid()
+    # Chrome trace times are in microseconds
+    events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": thread_id, "args": {"name": thread_name}}
+              for thread_id, thread_name in _thread_names.items()]
+    events += [{"name": names[int(_name_ids[i])], "ph": "X", "pid": pid, "tid": int(_thread_ids[i]),
+                "ts": _starts[i] * 1e6, "dur": (_ends[i] - _starts[i]) * 1e6} for i in valid]
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    return len(valid)